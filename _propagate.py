@@ -11,6 +11,19 @@ Created on Mon Feb 24 21:05:59 2020
 
 import numpy as np
 
+from fractions import Fraction
+
+
+###############################################################################
+# CONSTANT
+
+# The memory budget (bytes) of one tile of the Kirchhoff-Fresnel kernel
+memory_budget = 2**28
+
+# The last kernels of the matrix and convolution methods, [geometry, kernels]
+_transfer_cache = None
+_convolution_cache = None
+
 
 ###############################################################################
 # FUNCTION
@@ -20,6 +33,152 @@ def _enveloped_phase(phase):
     return np.arctan2(np.cos(phase), -1*np.sin(phase))
 
 
+def _tile(count, memory=None):
+
+    """
+    # Args:
+    #     count: The pixel number of the front plane.
+    #     memory: The memory budget of one tile (bytes), default memory_budget.
+
+    # Return:
+    #     The number of back pixels evaluated against the front plane at once.
+    """
+
+    if memory is None:
+        memory = memory_budget
+    # About four complex128 temporaries of the tile are alive at the same time
+    return max(1, int(memory // (4 * 16 * count)))
+
+def _dtype(precision):
+
+    """
+    # Args:
+    #     precision: "double", complex128; "single", complex64.
+
+    # Return:
+    #     The complex dtype of the wave fronts.
+    """
+
+    if precision == "double":
+        return np.dtype(np.complex128)
+    elif precision == "single":
+        return np.dtype(np.complex64)
+    else:
+        raise ValueError("unknown precision: %s" % precision)
+
+def _exp_phase(phase, dtype=complex):
+
+    """
+    # Args:
+    #     phase: The phase, float64.
+    #     dtype: The complex dtype of the result.
+
+    # Return:
+    #     exp(i*phase). In single precision the phase is first reduced modulo
+    #     2*pi in float64, the optical paths being ~1e12 rad.
+    """
+
+    if np.dtype(dtype) == np.complex64:
+        return np.exp(1j*np.mod(phase, 2*np.pi).astype(np.float32))
+    else:
+        return np.exp(1j*phase)
+
+def _cycles(length, wave_length):
+
+    # The phase of a long path, 2*pi times the fractional part of length/l
+    cycles = length / wave_length
+    return 2*np.pi * (cycles - np.floor(cycles))
+
+def _path(rho2, distance, wave_length):
+
+    """
+    # Args:
+    #     rho2: The squared transverse distance dx**2 + dy**2.
+    #     distance: The distance dz along the optical axis.
+    #     wave_length: The wave length of source.
+
+    # Return:
+    #     [r, phase]. r = sqrt(rho2 + dz**2) and phase = 2*pi*r/l modulo 2*pi,
+    #     as the constant phase of dz plus 2*pi*(r - dz)/l, where
+    #     r - dz = rho2/(r + dz). With dz ~ 1e7 um the phase 2*pi*r/l is
+    #     ~1e12 rad and loses ~1e-4 rad to rounding; the reformulated phase
+    #     is small and keeps full precision (also in float32).
+    """
+
+    distance = np.abs(distance)
+    length = np.sqrt(rho2 + distance**2)
+
+    return [
+        length,
+        _cycles(distance, wave_length) +
+        2*np.pi * rho2 / ((length + distance)*wave_length)
+        ]
+
+def _offsets(front, back):
+
+    """
+    # Args:
+    #     front：A class contains the properites of the plane of the sources.
+    #     back: A class contains the properties of plane back.
+
+    # Return:
+    #     [dx**2, ix, dy**2, iy]. The distances between the point sources and
+    #     the back pixels only take a small set of horizonal and vertical
+    #     offsets: dx**2 and dy**2 are the distinct squared offsets, and
+    #     dx**2[ix[source column, back column]] is the one of a pair.
+    """
+
+    dx = (front.mesh[0][0, :, np.newaxis]*front.pixel[0] -
+          back.mesh[0][0, :]*back.pixel[0])
+    dy = (front.mesh[1][:, 0, np.newaxis]*front.pixel[1] -
+          back.mesh[1][:, 0]*back.pixel[1])
+
+    dx2, ix = np.unique(dx**2, return_inverse = True)
+    dy2, iy = np.unique(dy**2, return_inverse = True)
+
+    return [dx2, np.reshape(ix, dx.shape), dy2, np.reshape(iy, dy.shape)]
+
+def _gather(table, shape, indices, offsets):
+
+    """
+    # Args:
+    #     table: A function of the distinct offsets, shape (dy**2, dx**2).
+    #     shape: The shape of the plane of the sources.
+    #     indices: The indices of the point sources.
+    #     offsets: The result of _offsets.
+
+    # Return:
+    #     The table at the offsets of each source and back pixel, of shape
+    #     (sources, ny, nx).
+    """
+
+    dx2, ix, dy2, iy = offsets
+    row, column = np.unravel_index(indices, shape)
+
+    return table[iy[row][:, :, np.newaxis], ix[column][:, np.newaxis, :]]
+
+class _LensPhase(object):
+    """The lens phase of mode 0, computed for one point source when needed."""
+
+    def __init__(self, front, mirror):
+
+        # Only the phase of the distinct offsets is stored, see _offsets
+        self.shape = front.mesh[0].shape
+        self.offsets = _offsets(front, mirror)
+        distance2 = self.offsets[2][:, np.newaxis] + self.offsets[0]
+
+        # The divergent spherical wave at the crl incident phase
+        dswave = _path(
+            distance2, mirror.location - front.location, mirror.source.wave_length
+            )[1]
+        # The convergent spherical wave at the crl incident phase
+        cswave = _path(distance2, mirror.focus, mirror.source.wave_length)[1]
+        self.table = _enveloped_phase(-1*cswave + -1*dswave)
+
+    def __call__(self, i):
+
+        return _gather(self.table, self.shape, [i], self.offsets)[0]
+
 def _lens(front, mirror, mode):
     
     """
@@ -31,66 +190,64 @@ def _lens(front, mirror, mode):
     #           if mode=0, the light of front plane is treated as a plane source
 
     # Return:
-    #     A 2-dimensional arrays of complex wave front at back plane
+    #     The phase of the lens: one 2-dimensional array shared by all the
+    #     point sources in mode 1, a function of the index of the point
+    #     source in mode 0.
     """
     
     if mode:
         
-        lens_result = None
+        distance2 = (mirror.mesh[0]*mirror.pixel[0])**2 + (mirror.mesh[1]*mirror.pixel[1])**2
         
         # The divergent spherical wave at the crl incident phase
-        dswave = (
-            2*np.pi *
-            np.sqrt((mirror.mesh[0]*mirror.pixel[0])**2 + (mirror.mesh[1]*mirror.pixel[1])**2 +
-                    (mirror.location - front.location)**2
-                    ) / mirror.source.wave_length
-            )
+        dswave = _path(
+            distance2, mirror.location - front.location, mirror.source.wave_length
+            )[1]
         # The convergent spherical wave at the crl incident phase
-        cswave = (
-            2*np.pi *
-            np.sqrt((mirror.mesh[0]*mirror.pixel[0])**2 + (mirror.mesh[1]*mirror.pixel[1])**2 +
-                    (mirror.focus)**2
-                    ) / mirror.source.wave_length
-            )
+        cswave = _path(distance2, mirror.focus, mirror.source.wave_length)[1]
         # The enveloped phase of mirror
-        phase_lens = _enveloped_phase(-1*cswave + -1*dswave)
-        lens_result = [phase_lens for i in range(mirror.source.source_count)]
+        return _enveloped_phase(-1*cswave + -1*dswave)
 
     else:
         
-        lens_result = []
-        
-        front_plane = [front.mesh[0].flatten(), front.mesh[1].flatten()]
-
-        # iter the plane front for the optical path length
-        for i in range(mirror.source.source_count):
-            # The divergent spherical wave at the crl incident phase
-            dswave = (
-                2*np.pi *
-                np.sqrt((mirror.mesh[0]*mirror.pixel[0] - front_plane[0][i]*front.pixel[0])**2 +
-                        (mirror.mesh[1]*mirror.pixel[1] - front_plane[1][i]*front.pixel[1])**2 +
-                        (mirror.location - front.location)**2
-                        ) / mirror.source.wave_length
-                )
-            # The convergent spherical wave at the crl incident phase
-            cswave = (
-                2*np.pi *
-                np.sqrt((mirror.mesh[0]*mirror.pixel[0] - front_plane[0][i]*front.pixel[0])**2 +
-                        (mirror.mesh[1]*mirror.pixel[1] - front_plane[1][i]*front.pixel[1])**2 +
-                        (mirror.focus)**2
-                        ) / mirror.source.wave_length
-                )
-            phase_lens = _enveloped_phase(-1*cswave + -1*dswave)
-            lens_result.append(phase_lens)
-            
-    return lens_result
+        return _LensPhase(front, mirror)
+
+def _lens_phase(front, i):
 
-def _source_spread(source, back):
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     i: The index of the point source.
+
+    # Return:
+    #     The phase of the lens of front for the point source i.
+    """
+
+    if front.lens is None:
+        return 0
+    elif callable(front.lens):
+        return front.lens(i)
+    elif np.ndim(front.lens) == 2:
+        return front.lens
+    else:
+        return front.lens[i]
+
+def _mask(front):
+
+    # The transmission of front, 1 without a mask
+    return 1 if front.mask is None else front.mask
+
+def _source_spread(source, back, method="exact", indices=None, memory=None):
 
     """
     # Args:
     #     source：A class contains the properites of source.
     #     back: A class contains the properties of plane back
+    #     method: "exact", the spherical wave of each point source;
+    #             "separable", the paraxial wave, the product of a horizonal
+    #             and a vertical phase.
+    #     indices: The indices of the point sources, default all.
+    #     memory: The memory budget of one block of sources (bytes).
     
     # Return:
     #     A 2-dimensional arrays of complex wave front at back plane
@@ -98,95 +255,664 @@ def _source_spread(source, back):
     
     # The propagation from source to the first element
     # if source.order == 0 and back.order == 1:
+    
+    if indices is None:
+        indices = range(source.source_count)
+    indices = np.asarray(indices, dtype = int)
+    distance = back.location - source.location
+    
+    # The optical path only depends on the offsets, computed once per offset
+    offsets = _offsets(source, back)
+    
+    if method == "separable":
+        # The paraxial optical path, vertical times horizonal
+        source_back_path = np.outer(
+            np.exp(1j*np.pi * offsets[2] / (source.wave_length*np.abs(distance))),
+            np.exp(1j*np.pi * offsets[0] / (source.wave_length*np.abs(distance)))
+            )
+        source_back_path = (
+            source_back_path *
+            np.exp(1j*_cycles(np.abs(distance), source.wave_length))
+            )
+    else:
+        # The optical path fron source to first element
+        source_back_path = np.exp(1j*_path(
+            offsets[2][:, np.newaxis] + offsets[0], distance, source.wave_length
+            )[1])
         
     # Initalize the wavefront of element back
-    wavefront = np.array(np.copy(back.zero), dtype=complex)
-    source_meshgrid = (source.mesh[0].flatten(), source.mesh[1].flatten())
+    back_wavefront = np.zeros((len(indices),) + back.zero.shape, dtype = complex)
     
-    back_wavefront = []
-    back_intensity = np.array(np.copy(back.zero))
+    # the iteration of the blocks of the source
+    block = _tile(back.zero.size, memory)
     
-    # the iteration of the source
-    for i in range(source.source_count):
-        # Calculate the wavefront under the effect of lens and error
-        abs_wave = np.abs(source.wavefront[i])
-        angle_wave = np.angle(source.wavefront[i])
-        # Calcualte the optical length between source to first element
-        source_back_length = np.sqrt(
-            # The horizonal direction
-            (source_meshgrid[0][i]*source.pixel[0] - back.mesh[0]*back.pixel[0])**2 +
-            # The vertical direction
-            (source_meshgrid[1][i]*source.pixel[1] - back.mesh[1]*back.pixel[1])**2 +
-            # The z direction
-            (back.location - source.location)**2
+    for start in range(0, len(indices), block):
+        
+        k = slice(start, start + block)
+        
+        # The wavefront of the point sources
+        wave = source.wavefront[indices[k]][:, np.newaxis, np.newaxis]
+        back_wavefront[k] = (
+            np.abs(wave) * np.exp(1j*np.angle(wave)) *
+            _gather(source_back_path, source.mesh[0].shape, indices[k], offsets)
             )
-        # The optical path fron source to back
-        source_back_path = 2*np.pi * source_back_length / source.wave_length
-#        wavefront = (
-#            (abs_wave/source_back_length) *
-#             np.exp(1j*(angle_wave + source_back_path))
-#            )
-        wavefront = abs_wave * np.exp(1j*(angle_wave + source_back_path))
-        back_wavefront.append(wavefront)
-        back_intensity = back_intensity + np.abs(wavefront)**2
+    
+    back_intensity = np.sum(np.abs(back_wavefront)**2, 0)
     
     return [back_wavefront, back_intensity]
 
-def _point(i, front, back):
+def _point(i, front, back, memory=None, dtype=complex):
+
+    """
+    # Args:
+    #     i: The index of the point source.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     memory: The memory budget of one tile (bytes).
+    #     dtype: The complex dtype of the integral.
+
+    # Return:
+    #     A 2-dimensional arrays of complex wave front at back plane
+    """
 
     # Initalize the wavefront of element back
-    wavefront = np.array(np.copy(back.zero.flatten()), dtype=complex)
-    back_meshgrid = (back.mesh[0].flatten(), back.mesh[1].flatten())
+    wavefront = np.array(np.copy(back.zero.flatten()), dtype=dtype)
+    real = np.finfo(wavefront.dtype).dtype
+    back_meshgrid = (back.mesh[0].flatten()*back.pixel[0],
+                     back.mesh[1].flatten()*back.pixel[1])
+    front_meshgrid = (front.mesh[0].flatten()*front.pixel[0],
+                      front.mesh[1].flatten()*front.pixel[1])
+    
+    # Calculate the wavefront under the effect of lens, mask and error
+    front_wave = front.wavefront[i]
+    abs_wave = (np.abs(front_wave) * _mask(front)).flatten()
+    angle_wave = (
+        np.angle(front_wave) + _lens_phase(front, i) + front.error
+        ).flatten()
     
-    # Calculate the wavefront under the effect of lens and error
-    abs_wave = np.abs(front.wavefront[i])
-    angle_wave = np.angle(front.wavefront[i]) + front.lens[i] + front.error 
+    # The tiles of the back plane, each one against the whole front plane
+    tile = _tile(front_meshgrid[0].size, memory)
     
-    # The iteration of the front plane
-    for k in range(back.count):
+    for start in range(0, back.count, tile):
+        
+        k = slice(start, min(start + tile, back.count))
 
-        # The optical length between front to back
-        front_back_length = np.sqrt(
+        # The optical length and path between front to back
+        front_back_length, front_back_path = _path(
             # The horizonal direction
-            (back_meshgrid[0][k]*back.pixel[0] - front.mesh[0]*front.pixel[0])**2 +
+            (back_meshgrid[0][k, np.newaxis] - front_meshgrid[0])**2 +
             # The vertical direction
-            (back_meshgrid[1][k]*back.pixel[1] - front.mesh[1]*front.pixel[1])**2 +
+            (back_meshgrid[1][k, np.newaxis] - front_meshgrid[1])**2,
             # The z direction
-            (back.location - front.location)**2
+            back.location - front.location,
+            front.source.wave_length
             )
-        # The optical path fron front to back
-        front_back_path = 2*np.pi * front_back_length / front.source.wave_length
         # The angle factor in Kirchhoff integral
         costhe = np.abs(back.location - front.location) / front_back_length
         # The integral process
         wavefront[k] = wavefront[k] + np.sum(
-            # The integral area
-            front.pixel[0]*front.pixel[1] *
-            abs_wave *
-            np.exp(1j*(angle_wave + front_back_path)) *
-            costhe / 
-            (front.source.wave_length*front_back_length)
+            (
+                # The integral area
+                front.pixel[0]*front.pixel[1] *
+                abs_wave *
+                costhe /
+                (front.source.wave_length*front_back_length)
+                ).astype(real) *
+            _exp_phase(angle_wave + front_back_path, dtype),
+            axis = 1
             )
  
     # The wavefront of point source
     wavefront = np.reshape(wavefront, (2*back.size[1] + 1, 2*back.size[0] + 1))
     return wavefront
-        
-def _kirchhoff_integral(front, back):
+
+def _geometry(front, back, dtype=complex):
+
+    # The key of the kernels of an element pair
+    return (
+        tuple(front.size), tuple(front.pixel), front.location,
+        tuple(back.size), tuple(back.pixel), back.location,
+        back.count, front.source.wave_length, np.dtype(dtype).str
+        )
+
+def _kernel(dx, dy, front, back, dtype=complex):
+
+    """
+    # Args:
+    #     dx, dy: The horizonal and vertical distances between back and front
+    #             pixels.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     dtype: The complex dtype of the kernel.
+
+    # Return:
+    #     The Kirchhoff-Fresnel kernel, with the integral area of one front
+    #     pixel.
+    """
+
+    # The optical length and path between front to back
+    front_back_length, front_back_path = _path(
+        dx**2 + dy**2, back.location - front.location, front.source.wave_length
+        )
+    # The angle factor in Kirchhoff integral
+    costhe = np.abs(back.location - front.location) / front_back_length
+
+    return (
+        (front.pixel[0]*front.pixel[1] *
+         costhe /
+         (front.source.wave_length*front_back_length)
+         ).astype(np.finfo(dtype).dtype) *
+        _exp_phase(front_back_path, dtype)
+        )
+
+def _transfer(front, back, k, dtype=complex):
+
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     k: The slice of the back pixels of this tile.
+    #     dtype: The complex dtype of the operator.
+
+    # Return:
+    #     A tile of the front to back transfer operator, one row per back
+    #     pixel and one column per front pixel.
+    """
+
+    back_meshgrid = (back.mesh[0].flatten()*back.pixel[0],
+                     back.mesh[1].flatten()*back.pixel[1])
+    front_meshgrid = (front.mesh[0].flatten()*front.pixel[0],
+                      front.mesh[1].flatten()*front.pixel[1])
+
+    return _kernel(
+        back_meshgrid[0][k, np.newaxis] - front_meshgrid[0],
+        back_meshgrid[1][k, np.newaxis] - front_meshgrid[1],
+        front, back, dtype
+        )
+
+def _operator(front, back, dtype=complex):
+
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     dtype: The complex dtype of the operator.
+
+    # Return:
+    #     The whole front to back transfer operator. The last operator is
+    #     kept, so it is computed once per element pair.
+    """
+
+    global _transfer_cache
+
+    key = _geometry(front, back, dtype)
+    if _transfer_cache is None or _transfer_cache[0] != key:
+        _transfer_cache = [key, _transfer(front, back, slice(0, back.count), dtype)]
+
+    return _transfer_cache[1]
+
+def _front_wave(indices, front, dtype=complex):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources.
+    #     front：A class contains the properites of plane front.
+    #     dtype: The complex dtype of the wave fronts.
+
+    # Return:
+    #     A 3-dimensional arrays of the complex wave fronts of front plane
+    #     under the effect of lens, mask and error, one per point source.
+    """
+
+    front_wave = np.zeros((len(indices),) + front.mesh[0].shape, dtype = dtype)
+
+    for n, i in enumerate(indices):
+        wave = front.wavefront[i]
+        front_wave[n] = (
+            np.abs(wave) * _mask(front) *
+            _exp_phase(np.angle(wave) + _lens_phase(front, i) +
+                       front.error, dtype)
+            )
+
+    return front_wave
+
+def _matrix(indices, front, back, memory=None, dtype=complex):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     memory: The memory budget of the operator, or of one tile (bytes).
+    #     dtype: The complex dtype of the operator and the product.
+
+    # Return:
+    #     A 3-dimensional arrays of complex wave fronts at back plane, one
+    #     per point source. The transfer operator is built once (or once per
+    #     tile) and applied to all the sources by one complex matrix product.
+    """
+
+    # The wavefronts of front plane, one row per point source
+    front_wave = np.reshape(
+        _front_wave(indices, front, dtype), (len(indices), front.mesh[0].size)
+        )
+
+    wavefronts = np.zeros((len(indices), back.zero.size), dtype = dtype)
+
+    # The operator tiles, each one is applied to all the sources at once
+    tile = _tile(front.mesh[0].size, memory)
+
+    shared = (_transfer_cache is not None and
+              _transfer_cache[0] == _geometry(front, back, dtype))
+    # The bytes of the whole operator, kept if they fit the budget
+    whole = back.count*front.mesh[0].size*np.dtype(dtype).itemsize <= (
+        memory_budget if memory is None else memory
+        )
+
+    if shared or whole:
+        # The whole operator fits the budget (or is shared by the node),
+        # keep it for the next calls
+        wavefronts[:, :back.count] = np.dot(front_wave, _operator(front, back, dtype).T)
+    else:
+        for start in range(0, back.count, tile):
+            k = slice(start, min(start + tile, back.count))
+            wavefronts[:, k] = np.dot(front_wave, _transfer(front, back, k, dtype).T)
+
+    return np.reshape(
+        wavefronts, (len(indices), 2*back.size[1] + 1, 2*back.size[0] + 1)
+        )
+
+def _chirp_z(wave, axis, front_pixel, back_pixel, back_half, distance, wave_length):
+
+    """
+    # Args:
+    #     wave: The complex wave fronts of front plane.
+    #     axis: The axis of the one dimensional Fresnel transform.
+    #     front_pixel, back_pixel: The pixel length along this axis.
+    #     back_half: The half pixel number of back plane along this axis.
+    #     distance: The distance between front and back.
+    #     wave_length: The wave length of source.
+
+    # Return:
+    #     The one dimensional Fresnel transform exp(i*pi*(xb - xf)**2/(l*z))
+    #     of wave, evaluated by a scaled (Bluestein) chirp-z transform, so
+    #     that front and back pixel lengths may differ.
+    """
+
+    wave = np.moveaxis(wave, axis, -1)
+    front_half = (wave.shape[-1] - 1) // 2
+
+    m = np.arange(-front_half, front_half + 1)
+    n = np.arange(-back_half, back_half + 1)
+    d = np.arange(-(front_half + back_half), front_half + back_half + 1)
+    scale = np.pi / (wave_length*distance)
+    beta = front_pixel*back_pixel
+
+    # xb*xf = (n**2 + m**2 - (n - m)**2)*beta/2, a convolution in n - m
+    chirp = wave * np.exp(1j*scale*(front_pixel**2 - beta)*m**2).astype(wave.dtype)
+    kernel = np.exp(1j*scale*beta*d**2).astype(wave.dtype)
+
+    length = 1 << (chirp.shape[-1] + kernel.size - 2).bit_length()
+    result = np.fft.ifft(
+        np.fft.fft(chirp, length) * np.fft.fft(kernel, length)
+        )[..., 2*front_half : 2*(front_half + back_half) + 1]
+    result = result * np.exp(1j*scale*(back_pixel**2 - beta)*n**2).astype(wave.dtype)
+
+    return np.moveaxis(result, -1, axis)
+
+def _fresnel_fft(indices, front, back, memory=None, dtype=complex):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     memory: The memory budget of one block of sources (bytes).
+    #     dtype: The complex dtype of the transforms.
+
+    # Return:
+    #     A 3-dimensional arrays of complex wave fronts at back plane, one
+    #     per point source, in the Fresnel approximation. The cost is
+    #     O(N log N) per source instead of O(N_front * N_back).
+    """
+
+    distance = np.abs(back.location - front.location)
+    wave_length = front.source.wave_length
+    shape = (2*back.size[1] + 1, 2*back.size[0] + 1)
+    
+    wavefronts = np.zeros((len(indices),) + shape, dtype = dtype)
+
+    # The blocks of sources, by the size of the padded transforms
+    rows = max(front.mesh[0].shape[0], shape[0])
+    columns = 2*(front.mesh[0].shape[1] + shape[1])
+    block = _tile(rows*columns, memory)
+
+    for start in range(0, len(indices), block):
+
+        k = slice(start, min(start + block, len(indices)))
+        wave = _front_wave(indices[k], front, dtype)
+        # The horizonal direction
+        wave = _chirp_z(wave, 2, front.pixel[0], back.pixel[0], back.size[0],
+                        distance, wave_length)
+        # The vertical direction
+        wave = _chirp_z(wave, 1, front.pixel[1], back.pixel[1], back.size[1],
+                        distance, wave_length)
+        wavefronts[k] = wave
+
+    return wavefronts * wavefronts.dtype.type(
+        front.pixel[0]*front.pixel[1] *
+        np.exp(1j*_cycles(distance, wave_length)) /
+        (wave_length*distance)
+        )
+
+def _fast_length(n):
+
+    """
+    # Return:
+    #     The smallest 2, 3, 5-smooth integer not less than n (FFT length).
+    """
+
+    length = n
+    while True:
+        rest = length
+        for factor in (2, 3, 5):
+            while rest % factor == 0:
+                rest //= factor
+        if rest == 1:
+            return length
+        length += 1
+
+def _polyphase(front_pixel, front_half, back_pixel, back_half):
+
+    """
+    # Args:
+    #     front_pixel, back_pixel: The pixel length along this axis.
+    #     front_half, back_half: The half pixel number along this axis.
+
+    # Return:
+    #     [step, grid, classes]. The pixel lengths are front = step*grid and
+    #     back = b*grid with integers step, b. The back pixels n of one class
+    #     share the residue r = b*n mod step, and their distance to the front
+    #     pixel m is (step*(t - m) + r)*grid: a discrete convolution in m.
+    #     Each class is [r, the positions of its back pixels, their t].
+    """
+
+    ratio = Fraction(front_pixel / back_pixel).limit_denominator(1000)
+    if abs(float(ratio)*back_pixel - front_pixel) > 1e-9*front_pixel:
+        raise ValueError(
+            "the pixel lengths %g and %g have no common grid" % (front_pixel, back_pixel)
+            )
+    step, b = ratio.numerator, ratio.denominator
+    grid = front_pixel / step
+
+    n = np.arange(-back_half, back_half + 1)
+    residue = (b*n) % step
+    classes = []
+
+    for r in np.unique(residue):
+        position = np.nonzero(residue == r)[0]
+        classes.append([r, position, (b*n[position] - r) // step])
+
+    return [step, grid, classes]
+
+def _convolution_kernel(front, back, memory=None, dtype=complex):
+
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     memory: The memory budget of the kernels (bytes).
+    #     dtype: The complex dtype of the kernels.
+
+    # Return:
+    #     [shape, kernels]. The padded FFT shape and, for every pair of
+    #     vertical and horizonal classes of _polyphase, the FFT of the exact
+    #     Kirchhoff-Fresnel kernel on the difference grid. The last kernels
+    #     are kept, so they are computed once per element pair.
+    """
+
+    global _convolution_cache
+
+    key = _geometry(front, back, dtype)
+    if _convolution_cache is not None and _convolution_cache[0] == key:
+        return _convolution_cache[1]
+
+    if memory is None:
+        memory = memory_budget
+
+    axes = [
+        _polyphase(front.pixel[i], front.size[i], back.pixel[i], back.size[i])
+        for i in (0, 1)
+        ]
+    # The padded lengths of the linear convolutions, common to all classes
+    shape = tuple(
+        _fast_length(
+            4*front.size[i] + 1 +
+            int(max(np.ptp(t) for r, position, t in axes[i][2]))
+            )
+        for i in (1, 0)
+        )
+
+    if (np.dtype(dtype).itemsize*len(axes[0][2])*len(axes[1][2])*
+            shape[0]*shape[1] > memory):
+        raise ValueError(
+            "the convolution kernels of %s exceed the memory budget" % back.name
+            )
+
+    kernels = []
+
+    for ry, position_y, ty in axes[1][2]:
+        for rx, position_x, tx in axes[0][2]:
+            # The offsets t - m of this class, from min(t) - M to max(t) + M
+            ux = np.arange(tx.min() - front.size[0], tx.max() + front.size[0] + 1)
+            uy = np.arange(ty.min() - front.size[1], ty.max() + front.size[1] + 1)
+            kernel = _kernel(
+                ((axes[0][0]*ux + rx)*axes[0][1])[np.newaxis, :],
+                ((axes[1][0]*uy + ry)*axes[1][1])[:, np.newaxis],
+                front, back
+                )
+            kernels.append([
+                position_y, ty - ty.min() + 2*front.size[1],
+                position_x, tx - tx.min() + 2*front.size[0],
+                np.fft.fft2(kernel, shape).astype(dtype)
+                ])
+
+    _convolution_cache = [key, [shape, kernels]]
+    return _convolution_cache[1]
+
+def _convolution(indices, front, back, memory=None, dtype=complex):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     memory: The memory budget of the kernels (bytes).
+    #     dtype: The complex dtype of the transforms.
+
+    # Return:
+    #     A 3-dimensional arrays of complex wave fronts at back plane, one
+    #     per point source. The kernel only depends on the difference of the
+    #     back and front coordinates, so the exact integral is a discrete
+    #     convolution, applied by zero padded FFTs.
+    """
+
+    shape, kernels = _convolution_kernel(front, back, memory, dtype)
+
+    wavefronts = np.zeros(
+        (len(indices), 2*back.size[1] + 1, 2*back.size[0] + 1), dtype = dtype
+        )
+
+    for n, i in enumerate(indices):
+
+        front_wave = np.fft.fft2(_front_wave([i], front, dtype)[0], shape)
+
+        for position_y, ty, position_x, tx, kernel in kernels:
+            result = np.fft.ifft2(front_wave * kernel)
+            wavefronts[n][np.ix_(position_y, position_x)] = result[np.ix_(ty, tx)]
+
+    return wavefronts
+
+def _fresnel_matrix(front_pixel, front_half, back_pixel, back_half, distance, wave_length):
+
+    """
+    # Args:
+    #     front_pixel, back_pixel: The pixel length along this axis.
+    #     front_half, back_half: The half pixel number along this axis.
+    #     distance: The distance between front and back.
+    #     wave_length: The wave length of source.
+
+    # Return:
+    #     The one dimensional paraxial kernel exp(i*pi*(xb - xf)**2/(l*z)),
+    #     one row per back pixel and one column per front pixel.
+    """
+
+    front_x = np.arange(-front_half, front_half + 1)*front_pixel
+    back_x = np.arange(-back_half, back_half + 1)*back_pixel
+
+    return np.exp(
+        1j*np.pi * (back_x[:, np.newaxis] - front_x)**2 / (wave_length*distance)
+        )
+
+def _separable(indices, front, back, dtype=complex):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     dtype: The complex dtype of the kernels and the products.
+
+    # Return:
+    #     A 3-dimensional arrays of complex wave fronts at back plane, one
+    #     per point source, in the paraxial approximation. The 2-dimensional
+    #     kernel is the product of a horizonal and a vertical kernel, so
+    #     each wave front is Ky . front . Kx^T, O(N**3) instead of O(N**4).
+    """
+
+    distance = np.abs(back.location - front.location)
+    wave_length = front.source.wave_length
+
+    horizonal = _fresnel_matrix(front.pixel[0], front.size[0], back.pixel[0],
+                                back.size[0], distance, wave_length).astype(dtype)
+    vertical = _fresnel_matrix(front.pixel[1], front.size[1], back.pixel[1],
+                               back.size[1], distance, wave_length).astype(dtype)
+
+    wavefronts = np.zeros(
+        (len(indices), 2*back.size[1] + 1, 2*back.size[0] + 1), dtype = dtype
+        )
+
+    for n, i in enumerate(indices):
+        wavefronts[n] = np.dot(
+            vertical, np.dot(_front_wave([i], front, dtype)[0], horizonal.T)
+            )
+
+    return wavefronts * wavefronts.dtype.type(
+        front.pixel[0]*front.pixel[1] *
+        np.exp(1j*_cycles(distance, wave_length)) /
+        (wave_length*distance)
+        )
+
+def _paraxial_bound(front, back):
+
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+
+    # Return:
+    #     The bound of the relative error of the paraxial kernel against the
+    #     exact one, over all pairs of front and back pixels: the phase
+    #     error 2*pi*rho**4/(8*l*z**3) plus the amplitude error rho**2/z**2
+    #     of costhe/r, rho the largest transverse distance.
+    """
+
+    distance = np.abs(back.location - front.location)
+    rho = np.sqrt(
+        (front.size[0]*front.pixel[0] + back.size[0]*back.pixel[0])**2 +
+        (front.size[1]*front.pixel[1] + back.size[1]*back.pixel[1])**2
+        )
+
+    return (
+        2*np.pi * rho**4 / (8*back.source.wave_length*distance**3) +
+        rho**2 / distance**2
+        )
+
+def _wavefronts(indices, front, back, method="point", precision="double"):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     method: "point", one Kirchhoff integral per point source;
+    #             "matrix", all the point sources by one matrix product;
+    #             "fresnel", the Fresnel approximation by chirp-z FFTs;
+    #             "convolution", the exact integral by FFT convolutions;
+    #             "separable", the paraxial approximation by 1-D kernels.
+    #     precision: "double", complex128; "single", complex64 with the
+    #                phases computed in float64.
+
+    # Return:
+    #     A 3-dimensional arrays of complex wave fronts at back plane
+    """
+
+    dtype = _dtype(precision)
+
+    if method == "point":
+        wavefronts = np.zeros(
+            (len(indices), 2*back.size[1] + 1, 2*back.size[0] + 1),
+            dtype = dtype
+            )
+        for n, i in enumerate(indices):
+            wavefronts[n] = _point(i, front, back, dtype = dtype)
+        return wavefronts
+    elif method == "matrix":
+        return _matrix(indices, front, back, dtype = dtype)
+    elif method == "fresnel":
+        return _fresnel_fft(indices, front, back, dtype = dtype)
+    elif method == "convolution":
+        return _convolution(indices, front, back, dtype = dtype)
+    elif method == "separable":
+        return _separable(indices, front, back, dtype = dtype)
+    else:
+        raise ValueError("unknown propagation method: %s" % method)
+
+def _kirchhoff_integral(front, back, method="point"):
 
     """
     # Args:
     #     front：A class contains the properites of plane front.
     #     back: A dict contains the properties of plane back
+    #     method: The propagation method, see _wavefronts.
 
     # Return:
     #     A 2-dimensional arrays of complex wave front at back plane
 
     # The meshed plane of front
     """
-    
-    back_wavefront = [_point(i, front, back) for i in range(front.source.source_count)]
-    back_intensity = np.sum(np.abs(np.array(back_wavefront))**2, 0)
-    back.wavefront = back_wavefront
+
+    back_wavefront = _wavefronts(range(len(front.wavefront)), front, back, method)
+    back_intensity = np.sum(np.abs(back_wavefront)**2, 0)
+    back.wavefront = list(back_wavefront)
     back.intensity = back_intensity
-        
+
+def _accuracy(indices, front, back, method, reference="point", precision="double"):
+
+    """
+    # Args:
+    #     indices: The indices of the point sources to compare.
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     method: The propagation method to check, see _wavefronts.
+    #     reference: The reference propagation method, in double precision.
+    #     precision: The precision of method.
+
+    # Return:
+    #     The relative error, max|result - reference| / max|reference|.
+    """
+
+    result = _wavefronts(indices, front, back, method, precision)
+    reference = _wavefronts(indices, front, back, reference)
+
+    return np.max(np.abs(result - reference)) / np.max(np.abs(reference))
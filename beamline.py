@@ -0,0 +1,326 @@
+#-----------------------------------------------------------------------------#
+# Copyright (c) 2020 Institute of High Energy Physics Chinese Academy of
+#                    Science
+#-----------------------------------------------------------------------------#
+
+__authors__  = "Han Xu - HEPS Hard X-ray Scattering Beamline (B4)"
+__date__     = "Date : 10.07.2020"
+__version__  = "Alpha-2.0"
+
+
+"""
+beamline: The source and the optical elements of a beamline, propagated in
+          one multi process job.
+
+Functions: beamline.
+           run.
+           sweep.
+
+Classes  : none.
+"""
+
+#-----------------------------------------------------------------------------#
+# libraries
+
+import copy
+import os
+import numpy as np
+import cache
+import elements
+import propagate
+
+#-----------------------------------------------------------------------------#
+# functions
+
+def _mask(mask):
+
+    # The transmission of a plane: None, an array or a .npy file
+    return np.load(mask) if isinstance(mask, str) else mask
+
+def beamline(description, batch=None):
+
+    """
+    # Args:
+    #     description: The beamline, {"source": source, "elements": [...]}.
+    #                  source: {"count", "wave_length", "sigma", "size",
+    #                           "pixel", "seed"}, the gauss source, the
+    #                           same whatever the ranks with a seed.
+    #                  elements: [{"name", "location", "size", "pixel",
+    #                              "focus", "mask", "cache", "modes"}, ...]
+    #                            in the order of the beam, focus (a lens),
+    #                            mask (the transmission, an array or a .npy
+    #                            file), cache (keep the element in the cache,
+    #                            see run) and modes (the fraction of the
+    #                            energy of the coherent modes propagated
+    #                            after the element instead of the sources,
+    #                            see propagate.compress) are optional.
+    #     batch: The batch of the run, each rank generates the point
+    #            sources of its own batches, see propagate.gauss_source.
+
+    # Return:
+    #     [source, elements], the instance of the source and the instances
+    #     of the elements.
+    """
+
+    parameters = description["source"]
+
+    source = elements.LightSource(
+        source_count = parameters["count"],
+        wave_length = parameters["wave_length"],
+        source_sigma = parameters["sigma"],
+        optic_planesize = parameters["size"],
+        optic_pixelsize = parameters["pixel"],
+        seed = parameters.get("seed")
+        )
+    propagate.gauss_source(source, distributed = True, batch = batch)
+
+    planes = list()
+
+    for order, parameters in enumerate(description["elements"]):
+
+        plane = elements.OpticElements(
+            source_class = source,
+            name = parameters["name"],
+            order = order + 1,
+            optic_location = parameters["location"],
+            optic_planesize = parameters["size"],
+            optic_pixelsize = parameters["pixel"],
+            optic_planecount = (
+                (2*parameters["size"][0] + 1)*(2*parameters["size"][1] + 1)
+                ),
+            optic_focus = parameters.get("focus")
+            )
+        plane.mask = _mask(parameters.get("mask"))
+        planes.append(plane)
+
+    return [source, planes]
+
+def _keys(description, method, mode, precision):
+
+    # The cache key of each element, the hash of the source, of the elements
+    # up to it and of the methods. None for a source without a seed.
+    if description["source"].get("seed") is None:
+        return [None for parameters in description["elements"]]
+
+    parts = [description["source"], method, mode, precision]
+    keys = list()
+
+    for parameters in description["elements"]:
+        mask = _mask(parameters.get("mask"))
+        parts = parts + [
+            {name: parameters.get(name)
+             for name in ("location", "size", "pixel", "focus", "modes")},
+            mask if mask is not None else "no mask"
+            ]
+        keys.append(cache.key(*parts))
+
+    return keys
+
+def _run(source, planes, description, keys, start, method, mode, batch,
+         precision, directory):
+
+    """
+    # Args:
+    #     source: The source of the beamline.
+    #     planes: The elements of the beamline, computed up to start.
+    #     description: The beamline, see beamline.
+    #     keys: The cache keys of the elements, see _keys.
+    #     start: The first element to compute.
+    #     method, mode, batch, precision, directory: See run.
+
+    # Return:
+    #     The elements from start are read from the cache or computed.
+    """
+
+    cached = [n >= start and parameters.get("cache") and key is not None and
+              cache.find(directory, key) is not None
+              for n, (parameters, key) in
+              enumerate(zip(description["elements"], keys))]
+    first = max([n for n in range(len(planes)) if cached[n]], default = -1)
+
+    for n in range(start, len(planes)):
+
+        plane = planes[n]
+
+        if cached[n]:
+
+            saved = propagate.load(
+                cache.find(directory, keys[n]),
+                "static" if n == first else "dynamic", batch
+                )
+            plane.wavefront = saved.wavefront
+            plane.intensity = saved.intensity
+            plane.lens = saved.lens
+
+        elif n > first:
+
+            if n == 0:
+                propagate.source_spread(
+                    source, plane, distributed = True, batch = batch
+                    )
+            else:
+                propagate.kirchhoff_integral(
+                    planes[n - 1], plane, method, batch = batch,
+                    precision = precision, distributed = True
+                    )
+
+            if plane.focus is not None:
+                propagate.lens(source, plane, mode)
+
+            if description["elements"][n].get("cache") and \
+                    keys[n] is not None:
+                propagate.save(plane, batch, os.path.join(directory, keys[n]))
+
+        # A lens not read from the cache is computed again
+        if plane.focus is not None and plane.lens is None:
+            propagate.lens(source, plane, mode)
+
+        # The elements before the last cached one are not computed
+        if n >= first and description["elements"][n].get("modes"):
+            propagate.compress(plane, description["elements"][n]["modes"])
+
+def _evict(directory, size):
+
+    # Remove the least recently used elements of the cache on rank 0
+    propagate.multi_process.Barrier()
+    if propagate.multi_process.Get_rank() == 0:
+        cache.evict(directory, size)
+    propagate.multi_process.Barrier()
+
+def run(description, method="point", mode=1, batch=None, precision="double",
+        directory="cache", size=2**34):
+
+    """
+    # Args:
+    #     description: The beamline, see beamline.
+    #     method: The propagation method between two elements, see
+    #             _propagate._wavefronts.
+    #     mode: The mode of the lenses, see propagate.lens.
+    #     batch: The number of sources in a batch, see
+    #            propagate.kirchhoff_integral.
+    #     precision: "double" or "single", see propagate.kirchhoff_integral.
+    #     directory: The directory of the cache. The elements with "cache"
+    #                are saved by the hash of the source (its seed), of the
+    #                geometry, focus and mask of the elements up to them and
+    #                of the methods, see cache.key.
+    #     size: The bytes of the cache, the least recently used elements
+    #           above it are removed at the end of the run.
+
+    # Return:
+    #     [source, elements]. Each rank keeps the wavefronts of its own
+    #     batches from the source to the last element, only the intensity
+    #     of each element is summed over the ranks. The computation starts
+    #     after the last element found in the cache; the elements before it
+    #     are not computed, the cached ones are read lazily.
+    """
+
+    source, planes = beamline(description, batch)
+    keys = _keys(description, method, mode, precision)
+
+    _run(source, planes, description, keys, 0, method, mode, batch,
+         precision, directory)
+    _evict(directory, size)
+
+    return [source, planes]
+
+def _point(description, point):
+
+    # The beamline of a sweep point, {"source" or the name of an element:
+    # {parameter: value}}
+    description = copy.deepcopy(description)
+
+    for name, parameters in point.items():
+        if name == "source":
+            description["source"].update(parameters)
+        else:
+            [element] = [element for element in description["elements"]
+                         if element["name"] == name]
+            element.update(parameters)
+
+    return description
+
+def sweep(description, points, method="point", mode=1, batch=None,
+          precision="double", directory="cache", size=2**34,
+          intensity_only=False):
+
+    """
+    # Args:
+    #     description: The beamline, see beamline.
+    #     points: The sweep points, a list of {"source" or the name of an
+    #             element: {parameter: value}} changing the description,
+    #             e.g. [{"sample_plane": {"location": 72e6}}, ...].
+    #     method, mode, batch, precision, directory, size: See run.
+    #     intensity_only: The wavefronts of the last elements are not kept.
+
+    # Return:
+    #     The last element of each point. The points are run in the order of
+    #     their stages, so the stages shared by consecutive points (the same
+    #     source and the same elements up to them) are computed once and
+    #     kept in memory, only the stages after are computed again. Each
+    #     point is distributed over the ranks by the sources, as run. A
+    #     source without a seed is given one, the same for all the points.
+    """
+
+    seed = description["source"].get("seed")
+    if seed is None:
+        seed = propagate.multi_process.bcast(
+            np.random.SeedSequence().entropy, root = 0
+            )
+
+    descriptions = [_point(description, point) for point in points]
+    for point in descriptions:
+        if point["source"].get("seed") is None:
+            point["source"]["seed"] = seed
+    keys = [_keys(point, method, mode, precision) for point in descriptions]
+
+    results = [None for point in points]
+    current = list()
+    previous = list()
+    source = None
+
+    for i in sorted(range(len(points)), key = lambda i: keys[i]):
+
+        # The stages shared with the previous point
+        start = 0
+        while start < min(len(current), len(keys[i])) and \
+                current[start] == keys[i][start]:
+            start = start + 1
+
+        new_source, planes = beamline(descriptions[i], batch)
+        if start == 0:
+            source = new_source
+        else:
+            planes[:start] = previous[:start]
+
+        _run(source, planes, descriptions[i], keys[i], start, method, mode,
+             batch, precision, directory)
+
+        current = keys[i]
+        previous = planes
+        results[i] = planes[-1]
+        if intensity_only:
+            planes[-1].wavefront = list()
+
+    _evict(directory, size)
+
+    return results
+
+#-----------------------------------------------------------------------------#
+# the beamline of the paper, from the source to the sample plane
+
+if __name__ == '__main__':
+
+    source, planes = run({
+        "source": {"count": 2079, "wave_length": 1e-4, "sigma": [9.5, 3.1],
+                   "size": [38, 13], "pixel": [0.5, 0.5], "seed": 0},
+        "elements": [
+            {"name": "lens", "location": 40e6, "size": [60, 60],
+             "pixel": [5.0, 5.0], "focus": 29.3e6, "cache": True},
+            {"name": "slit", "location": 69.3e6, "size": [10, 13],
+             "pixel": [0.5, 0.5], "cache": True},
+            {"name": "sample_plane", "location": 72.0e6, "size": [64, 64],
+             "pixel": [0.1575, 0.1575]}
+            ]
+        })
+
+    propagate.save(planes[-1])
@@ -0,0 +1,113 @@
+#-----------------------------------------------------------------------------#
+# Copyright (c) 2020 Institute of High Energy Physics Chinese Academy of
+#                    Science
+#-----------------------------------------------------------------------------#
+
+__authors__  = "Han Xu - HEPS Hard X-ray Scattering Beamline (B4)"
+__date__     = "Date : 10.07.2020"
+__version__  = "Alpha-2.0"
+
+
+"""
+cache: The elements saved on disk by the hash of what they are computed from,
+       the least recently used are removed above a size.
+
+Functions: key.
+           find.
+           evict.
+
+Classes  : none.
+"""
+
+#-----------------------------------------------------------------------------#
+# libraries
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+#-----------------------------------------------------------------------------#
+# functions
+
+def key(*parts):
+
+    """
+    # Args:
+    #     parts: The parameters (JSON) and the arrays an element is computed
+    #            from.
+
+    # Return:
+    #     The sha256 of the parts, the name of the element in the cache.
+    """
+
+    digest = hashlib.sha256()
+
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(("%s %s" % (part.shape, part.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(json.dumps(
+                part, sort_keys = True, default = lambda x: x.item()
+                ).encode())
+
+    return digest.hexdigest()
+
+def find(directory, key):
+
+    """
+    # Args:
+    #     directory: The directory of the cache.
+    #     key: The key of the element.
+
+    # Return:
+    #     The directory of the element if it is saved, marked as used now,
+    #     or None.
+    """
+
+    path = os.path.join(directory, key)
+    header = os.path.join(path, "header.json")
+
+    if not os.path.exists(header):
+        return None
+
+    os.utime(header)
+    return path
+
+def _size(path):
+
+    # The bytes of the files of a directory
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+def evict(directory, size):
+
+    """
+    # Args:
+    #     directory: The directory of the cache.
+    #     size: The bytes kept in the cache.
+
+    # Return:
+    #     The least recently used elements are removed until the cache is
+    #     not larger than size. An element is used when it is saved or found.
+    """
+
+    if not os.path.isdir(directory):
+        return
+
+    entries = list()
+    for name in os.listdir(directory):
+        header = os.path.join(directory, name, "header.json")
+        if os.path.exists(header):
+            entries.append([os.path.getmtime(header), name,
+                            _size(os.path.join(directory, name))])
+
+    total = sum(entry[2] for entry in entries)
+
+    for used, name, length in sorted(entries):
+        if total <= size:
+            break
+        shutil.rmtree(os.path.join(directory, name))
+        total = total - length
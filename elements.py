@@ -11,10 +11,13 @@ __version__  = "Alpha-2.0"
 """
 propagate: The phase of lens; Kirchhoff-Fresnel integral. (multi process)
 
-Functions: none.
+Functions: load.
            
 Classes  : LightSource.
            OpticElements.
+           WavefrontStore.
+           RankWavefronts.
+           Coherence.
            TestCoherentMdoes.
            
 """
@@ -23,12 +26,201 @@ Classes  : LightSource.
 # libraries
 
 import numpy as np
-import pickle
+import glob
+import json
+import os
 import matplotlib.pyplot as plt
+import _propagate
 
 #-----------------------------------------------------------------------------#
 # functions
 
+def _clear(path):
+    
+    # Create the directory of an element, or remove the element saved in it
+    os.makedirs(path, exist_ok = True)
+    for name in glob.glob(os.path.join(path, "*.npy")) + \
+            glob.glob(os.path.join(path, "header.json")):
+        os.remove(name)
+
+def _save_block(path, number, wavefront):
+    
+    # Save the block number of the wavefronts
+    np.save(os.path.join(path, "wavefront_%06d.npy" % number), wavefront)
+
+def _save_header(path, header, arrays, wavefront):
+    
+    """
+    # Args:
+    #     path: The directory of the element.
+    #     header: The parameters of the element (JSON).
+    #     arrays: The planes of the element, {name: array}.
+    #     wavefront: The count, chunk, shape and dtype of the blocks of the
+    #                wavefronts.
+    
+    # Return:
+    #     header.json and a .npy file of each plane. The header is written
+    #     after the blocks, an unfinished directory can not be loaded.
+    """
+    
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    
+    header["wavefront"] = wavefront
+    with open(os.path.join(path, "header.json"), "w") as file:
+        json.dump(header, file, indent = 4, default = lambda x: x.item())
+
+def _save(path, header, arrays, wavefront, chunk):
+    
+    """
+    # Args:
+    #     path: The directory of the element.
+    #     header: The parameters of the element (JSON).
+    #     arrays: The planes of the element, {name: array}.
+    #     wavefront: The wavefronts of the sources, or an empty list.
+    #     chunk: The number of sources in a block of wavefronts.
+    
+    # Return:
+    #     The directory contains header.json, a .npy file of each plane and
+    #     the wavefronts in blocks wavefront_000000.npy, ... of chunk sources.
+    """
+    
+    _clear(path)
+    
+    count = len(wavefront) if wavefront is not None else 0
+    blocks = {"count": count, "chunk": chunk}
+    
+    for number, start in enumerate(range(0, count, chunk)):
+        waves = np.asarray(wavefront[start:start + chunk])
+        _save_block(path, number, waves)
+        blocks["shape"] = list(waves.shape[1:])
+        blocks["dtype"] = waves.dtype.str
+    
+    _save_header(path, header, arrays, blocks)
+
+def load(path, indices=None):
+    
+    """
+    # Args:
+    #     path: The directory written by LightSource.save or
+    #           OpticElements.save.
+    #     indices: The indices of the sources read into memory, default
+    #              none, the others are read on indexing.
+    
+    # Return:
+    #     The element. Its planes are read, its wavefronts are a
+    #     WavefrontStore which only reads the blocks of the sources indexed.
+    #     A lens of one phase per source is memory mapped, a lens function
+    #     of mode 0 is computed again from the source.
+    """
+    
+    with open(os.path.join(path, "header.json")) as file:
+        header = json.load(file)
+    
+    if header["class"] == "LightSource":
+        element = _light_source(header)
+    else:
+        element = OpticElements(
+            source_class = _light_source(header["source"]),
+            name = header["name"],
+            order = header["order"],
+            optic_location = header["location"],
+            optic_planesize = header["size"],
+            optic_pixelsize = header["pixel"],
+            optic_planecount = header["count"],
+            optic_focus = header["focus"]
+            )
+        element.source_used = header.get("source_used")
+        element.intensity_error = header.get("intensity_error")
+        if header.get("lens_mode") == 0:
+            element.lens = _propagate._lens(element.source, element, 0)
+    
+    for name in ("intensity", "amplitude", "phase", "error", "lens", "mask"):
+        if os.path.exists(os.path.join(path, name + ".npy")):
+            setattr(element, name, np.load(
+                os.path.join(path, name + ".npy"),
+                mmap_mode = "r" if name == "lens" else None
+                ))
+    
+    lens = getattr(element, "lens", None)
+    if isinstance(lens, np.ndarray) and lens.ndim == 2:
+        element.lens = np.array(lens)
+    
+    if header["wavefront"]["count"]:
+        element.wavefront = WavefrontStore(path, header["wavefront"])
+        if indices is not None:
+            element.wavefront.load(indices)
+    
+    return element
+
+def _light_source(header):
+    
+    # The light source of the parameters in header
+    return LightSource(
+        name = header["name"],
+        order = header["order"],
+        source_count = header["source_count"],
+        wave_length = header["wave_length"],
+        source_sigma = header["sigma"],
+        optic_location = header["location"],
+        optic_planesize = header["size"],
+        optic_pixelsize = header["pixel"],
+        seed = header.get("seed")
+        )
+
+def _coherent_modes(wavefront, n, method="random", oversampling=10, power=2,
+                    reduce=None, seed=None):
+    
+    """
+    # Args:
+    #     wavefront: The wavefronts, one row per source (the rows of this
+    #                rank with reduce).
+    #     n: The number of modes.
+    #     method: "svd", the thin SVD of the wavefronts; "random", the
+    #             randomized SVD, the range of J is sampled with n +
+    #             oversampling random vectors and power iterations.
+    #     oversampling: The random vectors more than n.
+    #     power: The number of power iterations.
+    #     reduce: The sum over the ranks of an array ("random" only),
+    #             default one process.
+    #     seed: The seed of the random vectors.
+    
+    # Return:
+    #     [occupations, modes], the n largest eigen values of the cross
+    #     spectral density J = wavefront^H wavefront and the fields of the
+    #     modes (rows, J = sum of value * mode^H mode). J is never formed,
+    #     only (pixels, n + oversampling) arrays.
+    """
+    
+    if method == "svd":
+        u, s, vh = np.linalg.svd(wavefront, full_matrices = False)
+        return [s[:n]**2, vh[:n]]
+    
+    if reduce is None:
+        reduce = lambda array: array
+    
+    # The range of J, sampled by random vectors
+    omega = np.random.default_rng(seed).standard_normal(
+        (wavefront.shape[0], min(n + oversampling, wavefront.shape[1]))
+        )
+    sample = reduce(np.dot(wavefront.T.conjugate(), omega))
+    
+    for i in range(power):
+        sample = np.linalg.qr(sample)[0]
+        sample = reduce(
+            np.dot(wavefront.T.conjugate(), np.dot(wavefront, sample))
+            )
+    basis = np.linalg.qr(sample)[0]
+    
+    # J projected on the basis, its eigen vectors are the modes
+    projection = np.dot(wavefront, basis)
+    value, vector = np.linalg.eigh(
+        reduce(np.dot(projection.T.conjugate(), projection))
+        )
+    order = np.argsort(value)[::-1][:n]
+    
+    return [value[order], np.dot(basis, vector[:, order]).T.conjugate()]
+
 
 #-----------------------------------------------------------------------------#
 # classes
@@ -47,6 +239,7 @@ class LightSource(object):
             optic_location=0,
             optic_planesize=[None, None],
             optic_pixelsize=[None, None],
+            seed=None,
             ):
         
         """Return the properites of an optical elments.
@@ -62,6 +255,7 @@ class LightSource(object):
         #             pixel length of mesh,
         #             the pixel number of optical plane].
         #     foci: The focal length of the lens (crl....).
+        #     seed: The seed of the random phases, default a fresh one.
 
         # Return:
         """
@@ -73,6 +267,8 @@ class LightSource(object):
         self.source_count = source_count
         self.wave_length = wave_length
         self.sigma = source_sigma
+        # The entropy of the random phases, recorded to generate them again
+        self.seed = np.random.SeedSequence(seed).entropy
         
         # The structure of the plane
         self.location = optic_location
@@ -97,7 +293,7 @@ class LightSource(object):
         self.amplitude = np.copy(self.zero)
         self.phase = np.copy(self.zero)
 
-    def gauss_source(self):
+    def gauss_source(self, indices=None):
         """Given the gaussian paramters, generate a gauss source.
 
         # The phase is generated randomly. The intensity is gaussian,
@@ -108,6 +304,11 @@ class LightSource(object):
         #                unit: um.
         #    plane: The meshgrid plane of the source.
         #     sigma: The parameters sigma of gaussian.
+        #     indices: The indices of the point sources generated, default
+        #              all. The phase of the source i is drawn from its own
+        #              stream, SeedSequence(seed, spawn_key=(i,)), the i-th
+        #              spawned child of the seed, so it is the same whatever
+        #              process generates it. The phases not generated are nan.
 
         # Return:
         #     The intensity, amplitude, phase and the wavefront of source.
@@ -124,8 +325,15 @@ class LightSource(object):
                           )
 
         self.amplitude = np.sqrt(self.intensity)
-        self.phase = 2*np.pi * np.random.rand(np.shape(self.mesh[0])[0],
-                                              np.shape(self.mesh[0])[1])
+        
+        if indices is None:
+            indices = range(self.mesh[0].size)
+        phase = np.full(self.mesh[0].size, np.nan)
+        for i in indices:
+            phase[i] = 2*np.pi * np.random.Generator(np.random.PCG64(
+                np.random.SeedSequence(self.seed, spawn_key = (int(i),))
+                )).random()
+        self.phase = np.reshape(phase, self.mesh[0].shape)
         self.wavefront = self.amplitude*np.exp(1j*self.phase)
         self.wavefront = self.wavefront.flatten()
         
@@ -134,13 +342,22 @@ class LightSource(object):
         """
         plt.imshow(self.intensity)
         
-    def save(self):
-        """Save the element.
+    def header(self):
+        """The parameters of the source (JSON).
         """
-        with open(self.name + ".pkl", "wb") as file:
-            pickle.dump(self, file)
-            file.close()
-        np.savez_compressed(self.name + ".npz", intensity=self.intensity,amplitude=self.amplitude, phase=self.phase)
+        return {"class": "LightSource", "name": self.name,
+                "order": self.order, "source_count": self.source_count,
+                "wave_length": self.wave_length, "sigma": self.sigma,
+                "location": self.location, "size": self.size,
+                "pixel": self.pixel, "seed": self.seed}
+        
+    def save(self, chunk=4096):
+        """Save the source to the directory name, see load.
+        """
+        _save(self.name, self.header(),
+              {"intensity": self.intensity, "amplitude": self.amplitude,
+               "phase": self.phase},
+              self.wavefront, chunk)
             
             
 class OpticElements(object):
@@ -203,24 +420,49 @@ class OpticElements(object):
         self.intensity = np.copy(self.zero)
         self.amplitude = np.copy(self.zero)
         self.phase = np.copy(self.zero)
-        # The phase changed induced by lens
-        self.lens = [np.copy(self.zero) for i in range(source_class.source_count)]
+        # The phase changed induced by lens: None, one phase for all the
+        # point sources, or a function of the index of the point source
+        self.lens = None
+        # The transmission of the plane (an aperture or a slit): None or an
+        # array of the shape of the plane
         self.mask = None
+        # The number of sources of the intensity and its relative standard
+        # error, when it is estimated from a sample of the sources
+        self.source_used = None
+        self.intensity_error = None
         
-    def save(self):
-        """Save the element.
+    def header(self):
+        """The parameters of the element and its source (JSON).
         """
-        with open(self.name + ".pkl", "wb") as file:
-            pickle.dump(self, file)
-            file.close()
-        np.savez_compressed(self.name + ".npz", intensity=self.intensity, amplitude=self.amplitude, phase=self.phase, wavefront=np.array(self.wavefront), lens=np.array(self.lens))
+        return {"class": "OpticElements", "name": self.name,
+                "order": self.order, "location": self.location,
+                "size": self.size, "pixel": self.pixel, "count": self.count,
+                "focus": self.focus, "source": self.source.header(),
+                "source_used": self.source_used,
+                "intensity_error": self.intensity_error,
+                "lens_mode": 0 if callable(self.lens) else None}
+    
+    def arrays(self):
+        """The planes of the element, the lens and the mask if they are
+        arrays (a lens function of mode 0 is recorded in the header).
+        """
+        arrays = {"intensity": self.intensity, "amplitude": self.amplitude,
+                  "phase": self.phase, "error": self.error}
+        for name in ("lens", "mask"):
+            if isinstance(getattr(self, name), np.ndarray):
+                arrays[name] = getattr(self, name)
+        return arrays
+        
+    def save(self, chunk=256):
+        """Save the element to the directory name, the wavefronts in blocks
+        of chunk sources, see load.
+        """
+        _save(self.name, self.header(), self.arrays(), self.wavefront, chunk)
     
     def save_without_wavefronts(self):
         """Save the element without the wavefronts"""
         self.wavefront = list()
-        with open(self.name + "_nowfrs.pkl", "wb") as file:
-            pickle.dump(self, file)
-            file.close()
+        _save(self.name + "_nowfrs", self.header(), self.arrays(), None, 1)
         
     def show(self):
         """Plot the intensity of the plane.
@@ -228,6 +470,190 @@ class OpticElements(object):
         plt.imshow(self.intensity)
 
 
+class WavefrontStore(object):
+    """The wavefronts of an element saved in blocks, read on indexing."""
+    
+    def __init__(self, path, header):
+        """
+        # Args:
+        #     path: The directory of the element.
+        #     header: The "wavefront" entry of its header, includes
+        #             count, chunk, shape and dtype.
+        """
+        self.path = path
+        self.count = header["count"]
+        self.chunk = header["chunk"]
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        # The memory mapped blocks already opened
+        self.blocks = dict()
+        # The wavefronts read into memory, and their rows by source index
+        self.loaded = np.zeros((0,) + self.shape, dtype = self.dtype)
+        self.rows = np.full(self.count, -1)
+    
+    def __len__(self):
+        return self.count
+    
+    def block(self, number):
+        """The memory mapped block of wavefronts number."""
+        number = int(number)
+        if number not in self.blocks:
+            self.blocks[number] = np.load(
+                os.path.join(self.path, "wavefront_%06d.npy" % number),
+                mmap_mode = "r"
+                )
+        return self.blocks[number]
+    
+    def load(self, indices):
+        """Read the wavefronts of the sources indices into memory, each
+        block once.
+        """
+        indices = np.unique(np.asarray(indices, dtype = int))
+        self.loaded = self.read(indices)
+        self.rows[:] = -1
+        self.rows[indices] = np.arange(len(indices))
+    
+    def __getitem__(self, key):
+        """The wavefronts of the sources key (an index, a slice or indices),
+        from memory if they are loaded, otherwise only their blocks are read.
+        """
+        indices = np.arange(self.count)[key]
+        rows = self.rows[indices]
+        
+        if np.all(rows >= 0):
+            return np.array(self.loaded[rows])
+        
+        return self.read(indices)
+    
+    def read(self, indices):
+        """Read the wavefronts of the sources indices from their blocks."""
+        if np.ndim(indices) == 0:
+            return np.array(self.block(indices // self.chunk)[indices % self.chunk])
+        
+        wavefront = np.zeros((len(indices),) + self.shape, dtype = self.dtype)
+        blocks = indices // self.chunk
+        for number in np.unique(blocks):
+            k = blocks == number
+            wavefront[k] = self.block(number)[indices[k] - number*self.chunk]
+        return wavefront
+    
+    def __array__(self, dtype=None, copy=None):
+        wavefront = self[:]
+        return wavefront if dtype is None else wavefront.astype(dtype)
+
+
+class RankWavefronts(object):
+    """The wavefronts of the sources of one rank, indexed by source."""
+    
+    def __init__(self, count, indices, wavefront):
+        """
+        # Args:
+        #     count: The number of sources.
+        #     indices: The indices of the sources of this rank.
+        #     wavefront: Their wavefronts, one per index.
+        """
+        self.count = count
+        self.indices = np.asarray(indices, dtype = int)
+        self.wavefront = wavefront
+        self.shape = wavefront.shape[1:]
+        self.dtype = wavefront.dtype
+        # The rows of the wavefronts by source index, -1 on other ranks
+        self.rows = np.full(count, -1)
+        self.rows[self.indices] = np.arange(len(self.indices))
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, key):
+        """The wavefronts of the sources key of this rank."""
+        rows = self.rows[np.arange(self.count)[key]]
+        if np.any(rows < 0):
+            raise IndexError("The wavefronts of other ranks are not here.")
+        return self.wavefront[rows]
+
+
+class Coherence(object):
+    """The cross spectral density of a plane along a horizontal and a
+    vertical cut, and a low rank sketch of it, summed over the wavefronts
+    as they arrive."""
+    
+    def __init__(self, element_class=None, row=None, column=None, rank=20,
+                 seed=0):
+        """
+        # Args:
+        #     element_class: The element of the wavefronts.
+        #     row, column: The horizontal and the vertical cut, default the
+        #                  center of the plane.
+        #     rank: The number of random vectors of the sketch of J, 0 none.
+        #     seed: The seed of the random vectors, the same on all the
+        #           ranks so that the sketches can be summed.
+        """
+        shape = element_class.zero.shape
+        self.row = shape[0] // 2 if row is None else row
+        self.column = shape[1] // 2 if column is None else column
+        # The number of wavefronts summed
+        self.count = 0
+        self.intensity = np.zeros(shape)
+        # The cross spectral density along the cuts, (nx, nx) and (ny, ny)
+        self.horizontal = np.zeros((shape[1], shape[1]), dtype = complex)
+        self.vertical = np.zeros((shape[0], shape[0]), dtype = complex)
+        # The sketch J.omega of J = wavefront^H wavefront, (pixels, rank)
+        self.omega = np.random.default_rng(seed).standard_normal(
+            (shape[0]*shape[1], rank)
+            )
+        self.sketch = np.zeros((shape[0]*shape[1], rank), dtype = complex)
+    
+    def update(self, wavefront):
+        """Add a batch of wavefronts (count, ny, nx) to the sums."""
+        wavefront = np.asarray(wavefront)
+        cut = wavefront[:, self.row, :]
+        self.horizontal += np.dot(cut.T.conjugate(), cut)
+        cut = wavefront[:, :, self.column]
+        self.vertical += np.dot(cut.T.conjugate(), cut)
+        
+        wavefront = np.reshape(wavefront, (len(wavefront), -1))
+        self.sketch += np.dot(
+            wavefront.T.conjugate(), np.dot(wavefront, self.omega)
+            )
+        self.intensity += np.reshape(
+            np.sum(np.abs(wavefront)**2, 0), self.intensity.shape
+            )
+        self.count += len(wavefront)
+    
+    def arrays(self):
+        """The sums, added element by element to reduce over the ranks."""
+        return [self.intensity, self.horizontal, self.vertical, self.sketch]
+    
+    def degree(self):
+        """The degree of coherence along the cuts, [horizontal, vertical],
+        |J(x1, x2)| / sqrt(I(x1) I(x2)).
+        """
+        return [np.abs(csd) / np.sqrt(np.outer(
+                    np.abs(np.diag(csd)), np.abs(np.diag(csd))
+                    ).clip(np.finfo(float).tiny))
+                for csd in (self.horizontal, self.vertical)]
+    
+    def modes(self, n=None):
+        """The n largest occupations and the modes of J from the sketch
+        (Nystrom approximation), [occupations, modes], the modes as rows.
+        """
+        shift = np.sqrt(self.sketch.size) * np.finfo(float).eps * \
+            np.linalg.norm(self.sketch)
+        sketch = self.sketch + shift*self.omega
+        core = np.dot(self.omega.T, sketch)
+        factor = np.linalg.cholesky((core + core.T.conjugate()) / 2)
+        u, s, vh = np.linalg.svd(
+            np.linalg.solve(factor, sketch.T.conjugate()).T.conjugate(),
+            full_matrices = False
+            )
+        value = np.clip(s**2 - shift, 0, None)[:n]
+        return [value, u[:, :len(value)].T.conjugate()]
+    
+    def coherent_fraction(self):
+        """The occupation of the first mode over the total intensity."""
+        return self.modes(1)[0][0] / np.sum(self.intensity)
+
+
 class TestCoherentMode(object):
     """Test the coherent mode propagation."""
     
@@ -243,28 +669,30 @@ class TestCoherentMode(object):
         self.J = None
         self.element = element_class
     
-    def create_mode(self):
-        
-        from mathmatrix import arnoldi
-        
+    def create_mode(self, method="random"):
+        """The n coherent modes of the element and their occupations, from
+        its wavefronts directly, see _coherent_modes.
+        """
         wavefront = np.array(self.element.wavefront)
         repeats, sx, sy = wavefront.shape
         wavefront = np.reshape(wavefront, (repeats, sx*sy))
         
-        self.J = np.dot(wavefront.T.conjugate(), wavefront)
-        self.eig_value, eig_vector = arnoldi(self.J, num_eigvectors = self.n)
-        self.mode = [np.reshape(np.matrix(eig_vector[i, :]), (sx, sy)) for i in range(self.n)]
-        
+        self.eig_value, eig_vector = _coherent_modes(
+            wavefront, self.n, method
+            )
+        self.mode = [np.reshape(eig_vector[i, :], (sx, sy))
+                     for i in range(len(self.eig_value))]
         
     def create_J(self):
-        
+        """The cross spectral density of the modes, sum of value*mode^H*mode
+        (pixels**2, for small planes).
+        """
         mode = np.array(self.mode)
         num, sx, sy = mode.shape
         mode = np.reshape(mode, (num, sx*sy))
         
         for i in range(num):
-            mode[i, :] = mode[i, :]*self.eig_value[i]
-        mode = np.matrix(mode)
+            mode[i, :] = mode[i, :]*np.sqrt(self.eig_value[i])
         self.J = np.dot(mode.T.conjugate(), mode)
         
     
\ No newline at end of file
@@ -25,14 +25,14 @@ Classes  : none.
 #-----------------------------------------------------------------------------#
 # libaries
 
-import pickle
+import elements
 import matplotlib.pyplot as plt
 import numpy as np
 
 #-----------------------------------------------------------------------------#
 # plot secondary source
 
-secondary_source = pickle.load(open("secondary_source.pkl", 'rb'))
+secondary_source = elements.load("secondary_source")
 
 x = np.linspace(-30*0.5, 30*0.5, 61)
 y = np.linspace(-15*0.5, 15*0.5, 31)
@@ -45,7 +45,7 @@ plt.colorbar()
 #-----------------------------------------------------------------------------#
 # plot sample plane
 
-sample_plane = pickle.load(open("sample_plane.pkl", 'rb'))
+sample_plane = elements.load("sample_plane")
 
 x = np.linspace(-64*0.1575, 64*0.1575, 129)
 y = np.linspace(-64*0.1575, 64*0.1575, 129)
@@ -11,9 +11,18 @@ __version__  = "Alpha-2.0"
 """
 propagate: The phase of lens; Kirchhoff-Fresnel integral. (multi process)
 
-Functions: lens.
+Functions: gauss_source.
+           lens.
            source_spread.
            kirchhoff_integral.
+           fresnel_fft.
+           accuracy.
+           paraxial_bound.
+           share.
+           load.
+           save.
+           coherent_modes.
+           compress.
            
 Classes  : none.
 """
@@ -22,7 +31,11 @@ Classes  : none.
 # libraries
 
 import numpy as np
+import os
+import queue
+import threading
 import time
+import elements
 import _propagate
 import mpi4py.MPI as mpi
 
@@ -34,96 +47,979 @@ from mpi4py.MPI import COMM_WORLD as multi_process
 # The number of the multi_process
 process_number = mpi.COMM_WORLD.Get_size()
 
+# The node shared memory windows and the arrays built on them, kept open
+_windows = list()
+
 #-----------------------------------------------------------------------------#
 # functions
 
-def lens(front, mirror, mode):
+def _part(count, rank):
+    
+    # The contiguous range of source indices of a rank
+    return range(count*rank // process_number, count*(rank + 1) // process_number)
+
+def _allgather(local, count, datatype):
+    
+    """
+    # Args:
+    #     local: The contiguous array of the planes of the sources of this
+    #            rank, see _part.
+    #     count: The number of sources.
+    #     datatype: The MPI datatype of local.
+    
+    # Return:
+    #     The array of the planes of all the sources, on every rank, gathered
+    #     by one buffer based Allgatherv.
+    """
+    
+    plane = local.shape[1:]
+    size = int(np.prod(plane))
+    counts = [len(_part(count, rank))*size for rank in range(process_number)]
+    displacements = [sum(counts[:rank]) for rank in range(process_number)]
     
+    result = np.zeros((count,) + plane, dtype = local.dtype)
+    multi_process.Allgatherv(
+        [np.ascontiguousarray(local), datatype],
+        [result, (counts, displacements), datatype]
+        )
+    
+    return result
 
+def _node_allgather(local, count, datatype):
+    
+    """
+    # Args:
+    #     local, count, datatype: See _allgather.
+    
+    # Return:
+    #     The array of the planes of all the sources, in a shared memory
+    #     window of each node, one copy per node. Each rank writes its
+    #     sources into the window of its node, then the roots of the nodes
+    #     sum their windows, zero out of the sources of their ranks.
+    """
+    
     rank = multi_process.Get_rank()
+    node = multi_process.Split_type(mpi.COMM_TYPE_SHARED)
+    root = node.Get_rank() == 0
+    
+    result = _window((count,) + local.shape[1:], local.dtype, node)
+    if root:
+        result[...] = 0
+    node.Barrier()
+    
+    part = _part(count, rank)
+    result[part.start:part.stop] = local
+    node.Barrier()
+    
+    roots = multi_process.Split(0 if root else mpi.UNDEFINED, rank)
+    if root:
+        roots.Allreduce(mpi.IN_PLACE, [result, datatype], op = mpi.SUM)
+        roots.Free()
+    node.Barrier()
+    
+    return result
 
-    if rank == 0:
-        result = _propagate._lens(front, mirror, mode)
+def _indices(count, distributed, batch, tolerance, seed):
+    
+    # The sources a rank propagates in source_spread: all the ones it may
+    # sample with a tolerance, see _adaptive
+    if tolerance is not None:
+        return _sample(count, batch, seed)
+    elif distributed:
+        return _own(count, batch)
     else:
-        result = None
+        return _part(count, multi_process.Get_rank())
+
+def gauss_source(source, distributed=False, batch=None, tolerance=None,
+                 order_seed=0):
+    
+    # Each rank generates only the point sources it propagates in
+    # source_spread of the same arguments (order_seed is its seed of the
+    # order of the sources, the phases are drawn from source.seed), from the
+    # streams of their indices, see elements.LightSource.gauss_source. A
+    # source without a seed takes the entropy of rank 0, as the ranks draw
+    # their own
+    source.seed = multi_process.bcast(source.seed, root = 0)
+    source.gauss_source(_indices(
+        source.source_count, distributed, batch, tolerance, order_seed
+        ))
+
+def lens(front, mirror, mode):
+    
+    # One phase for all the sources in mode 1, a function of the source in
+    # mode 0; both are cheaper to compute on every rank than to send
+    mirror.lens = _propagate._lens(front, mirror, mode)
+
+def source_spread(source, back, method="exact", distributed=False, batch=None,
+                  tolerance=None, seed=0, shared=False):
+    
+    # With distributed, each rank keeps the wavefronts of its own batches
+    # for a distributed kirchhoff_integral of the same batch. With a
+    # tolerance, only the intensity is estimated, see _adaptive. With
+    # shared, the wavefronts are gathered straight into node shared memory,
+    # one copy per node, see share.
+    count = source.source_count
+    indices = _indices(count, distributed, batch, tolerance, seed)
+    
+    # The sources not generated by gauss_source have a nan phase
+    if multi_process.allreduce(
+            bool(np.any(np.isnan(np.ravel(source.phase)[indices]))),
+            op = mpi.LOR
+            ):
+        raise ValueError(
+            "the point sources of a rank are not generated, call "
+            "gauss_source with the arguments of source_spread"
+            )
+    
+    if tolerance is not None:
+        _adaptive(
+            lambda indices: _propagate._source_spread(
+                source, back, method, indices
+                )[0],
+            back, count, back.zero.shape, batch, tolerance, seed
+            )
+        return
+    
+    result = _propagate._source_spread(source, back, method, indices)
+    wavefront = np.reshape(
+        np.array(result[0], dtype = np.complex128), (-1,) + back.zero.shape
+        )
+    
+    # Gather the wavefronts and sum the intensity
+    if distributed:
+        back.wavefront = elements.RankWavefronts(count, indices, wavefront)
+    elif shared:
+        back.wavefront = _node_allgather(wavefront, count, mpi.DOUBLE_COMPLEX)
+    else:
+        back.wavefront = _allgather(wavefront, count, mpi.DOUBLE_COMPLEX)
+    back.intensity = np.zeros(back.zero.shape)
+    multi_process.Allreduce(
+        [np.array(result[1], dtype = float), mpi.DOUBLE],
+        [back.intensity, mpi.DOUBLE], op = mpi.SUM
+        )
+
+def _datatype(dtype):
+    
+    # The MPI datatype of the complex wavefronts
+    return mpi.COMPLEX if dtype == np.complex64 else mpi.DOUBLE_COMPLEX
 
-    recv_data = multi_process.bcast(result, root = 0)
-    mirror.lens = recv_data
+def _batch(source_count, batch):
+    
+    # The number of sources in a batch, default about eight batches per rank
+    return max(1, source_count // (8*process_number)) if batch is None else batch
+
+def _batches(indices, batch):
+    
+    # The batches of source indices, a batch is tagged by its number
+    return [indices[i:i + batch] for i in range(0, len(indices), batch)]
 
-def source_spread(source, back):
+def _own(source_count, batch):
+    
+    # The source indices of the batches of a rank in the static schedule
+    batches = _batches(np.arange(source_count), _batch(source_count, batch))
+    return np.array(
+        [i for number in _schedule(len(batches), "static")
+         for i in batches[number]], dtype = int
+        )
+
+def _schedule(count, schedule):
+    
+    """
+    # Args:
+    #     count: The number of batches.
+    #     schedule: "static", the batches are dealt round robin to the ranks;
+    #               "dynamic", the ranks pull the next batch from a shared
+    #               counter on rank 0 when they are free (work stealing),
+    #               kept progressing by a thread of rank 0, see _progress.
+    
+    # Return:
+    #     A generator of the numbers of the batches computed by this rank.
+    """
     
     rank = multi_process.Get_rank()
+    
+    if schedule == "static":
+        
+        for number in range(rank, count, process_number):
+            yield number
+            
+    elif schedule == "dynamic":
+        
+        # The counter of the next batch, in a window of rank 0
+        counter_buffer = np.zeros(int(rank == 0), dtype = np.int64)
+        counter = mpi.Win.Create(counter_buffer, 8, comm = multi_process)
+        one = np.ones(1, dtype = np.int64)
+        number = np.zeros(1, dtype = np.int64)
+        end = _progress(_poll) if rank == 0 else (lambda: None)
+        
+        while True:
+            
+            counter.Lock(0, mpi.LOCK_SHARED)
+            counter.Fetch_and_op(
+                [one, mpi.INT64_T], [number, mpi.INT64_T], 0, 0, mpi.SUM
+                )
+            counter.Unlock(0)
+            
+            if number[0] >= count:
+                break
+            yield int(number[0])
+        
+        end()
+        counter.Free()
+        
+    else:
+        raise ValueError("unknown schedule: %s" % schedule)
 
-    if rank == 0:
-        result = _propagate._source_spread(source, back)
+def _poll():
+    
+    # An MPI call without a message, for the progress of the counter
+    multi_process.Iprobe(source = mpi.ANY_SOURCE, tag = mpi.ANY_TAG)
+    return False
+
+def _progress(poll):
+    
+    """
+    # Args:
+    #     poll: A function making an MPI call, True if it got a message.
+    
+    # Return:
+    #     A function ending the thread started here. Without an MPI call,
+    #     the one-sided counter of the dynamic schedule and the sends to
+    #     rank 0 do not progress while rank 0 computes, so the other ranks
+    #     wait for it. The thread calls poll until it is ended, a millisecond
+    #     apart when there is no message. No thread is started if MPI is
+    #     not initialized with MPI_THREAD_MULTIPLE (the mpi4py default).
+    """
+    
+    if mpi.Query_thread() < mpi.THREAD_MULTIPLE:
+        return lambda: None
+    
+    stop = threading.Event()
+    
+    def run():
+        while not stop.is_set():
+            if not poll():
+                time.sleep(1e-3)
+    
+    thread = threading.Thread(target = run, daemon = True)
+    thread.start()
+    
+    def end():
+        stop.set()
+        thread.join()
+    
+    return end
+
+def _receive(batches, shape, wait, dtype):
+    
+    """
+    # Args:
+    #     batches: The batches of source indices.
+    #     shape: The shape of the back plane.
+    #     wait: Wait for a message, or return None if there is none.
+    #     dtype: The complex dtype of the wavefronts.
+    
+    # Return:
+    #     [number, wavefronts] of a batch computed by another rank, in the
+    #     order of completion.
+    """
+    
+    status = mpi.Status()
+    
+    if wait:
+        message = multi_process.Mprobe(
+            source = mpi.ANY_SOURCE, tag = mpi.ANY_TAG, status = status
+            )
     else:
-        result = None    
+        message = multi_process.Improbe(
+            source = mpi.ANY_SOURCE, tag = mpi.ANY_TAG, status = status
+            )
+        if message is None:
+            return None
+    
+    number = status.Get_tag()
+    wavefronts = np.zeros((len(batches[number]),) + shape, dtype = dtype)
+    message.Recv([wavefronts, _datatype(dtype)])
+    
+    return [number, wavefronts]
+
+def _order(count, seed):
+    
+    # The random order of the sources in _adaptive
+    return np.random.default_rng(seed).permutation(count)
+
+def _sample(count, batch, seed):
+    
+    # The source indices of a rank in all the rounds of _adaptive
+    rank = multi_process.Get_rank()
+    batch = _batch(count, batch)
+    order = _order(count, seed)
+    step = batch*process_number
+    return np.array(
+        [i for start in range(0, count, step)
+         for i in order[start + rank*batch:start + (rank + 1)*batch]],
+        dtype = int
+        )
+
+def _adaptive(compute, back, count, shape, batch, tolerance, seed):
+    
+    """
+    # Args:
+    #     compute: The function of the wavefronts of back of source indices.
+    #     back: A class contains the properties of plane back.
+    #     count: The number of sources.
+    #     shape: The shape of back.
+    #     batch: The number of sources of a rank in a round.
+    #     tolerance: The relative standard error of the intensity to stop.
+    #     seed: The seed of the order of the sources.
+    
+    # Return:
+    #     The intensity of back estimated from a random sample of the
+    #     sources, on all the ranks. The sources are taken in a random order,
+    #     one batch per rank and round; after each round the sums of |E|**2
+    #     and |E|**4 are reduced, and the sampling stops (after two rounds at
+    #     least) when the standard error of the estimate, relative to it, is
+    #     below tolerance. back.source_used and back.intensity_error record
+    #     the sample, the wavefronts are not stored.
+    """
+    
+    rank = multi_process.Get_rank()
+    batch = _batch(count, batch)
+    order = _order(count, seed)
+    step = batch*process_number
+    
+    # The sums of |E|**2 and |E|**4 of the sources of this rank
+    sums = np.zeros((2,) + tuple(shape))
+    
+    for start in range(0, count, step):
+        
+        indices = order[start + rank*batch:start + (rank + 1)*batch]
+        if len(indices):
+            intensity = np.abs(compute(indices))**2
+            sums[0] += np.sum(intensity, 0)
+            sums[1] += np.sum(intensity**2, 0)
+        
+        total = _sum(sums)
+        used = min(start + step, count)
+        mean = total[0] / used
+        # The variance of the mean, sampled without replacement
+        variance = (
+            np.clip(total[1] / used - mean**2, 0, None) / used *
+            (1 - used / count)
+            )
+        error = np.sqrt(
+            np.sum(variance) / max(np.sum(mean**2), np.finfo(float).tiny)
+            )
         
-    # Broadcast
-    recv_data = multi_process.bcast(result, root = 0)
-    back.wavefront = recv_data[0]
-    back.intensity = recv_data[1]
+        if start > 0 and error <= tolerance:
+            break
+    
+    back.wavefront = list()
+    back.intensity = count*mean
+    back.source_used = used
+    back.intensity_error = error
+
+def _store(back, indices, wavefronts, done, coherence):
+    
+    # Write a batch of wavefronts to back and add it to the intensity
+    back.wavefront[indices] = wavefronts
+    back.intensity = back.intensity + np.sum(np.abs(wavefronts)**2, 0)
+    done[indices] = True
+    if coherence is not None:
+        coherence.update(wavefronts)
 
-def kirchhoff_integral(front, back):
+def _reduce_coherence(coherence, root=None):
+    
+    # Sum the coherence of all the ranks on root, or on all the ranks
+    for array in coherence.arrays():
+        if root is None:
+            multi_process.Allreduce(mpi.IN_PLACE, array, op = mpi.SUM)
+        elif multi_process.Get_rank() == root:
+            multi_process.Reduce(mpi.IN_PLACE, array, op = mpi.SUM, root = root)
+        else:
+            multi_process.Reduce(array, None, op = mpi.SUM, root = root)
+    coherence.count = multi_process.allreduce(coherence.count)
+
+def _save_checkpoint(back, done, checkpoint):
+    
+    """
+    # Args:
+    #     back: A class contains the properties of plane back, its wavefronts
+    #           memory mapped to checkpoint + ".npy".
+    #     done: The mask of the finished sources.
+    #     checkpoint: The path prefix of the checkpoint files.
+    
+    # Return:
+    #     The wavefronts are flushed, then the mask of the finished sources
+    #     and their intensity are replaced together in checkpoint + ".npz".
+    """
+    
+    back.wavefront.flush()
+    
+    with open(checkpoint + ".npz.tmp", "wb") as file:
+        np.savez(file, done = done, intensity = back.intensity)
+    os.replace(checkpoint + ".npz.tmp", checkpoint + ".npz")
+
+def _load_checkpoint(back, checkpoint, source_count, shape, dtype, resume):
+    
+    """
+    # Args:
+    #     back: A class contains the properties of plane back.
+    #     checkpoint: The path prefix of the checkpoint files, or None.
+    #     source_count: The number of sources.
+    #     shape: The shape of the back plane.
+    #     dtype: The complex dtype of the wavefronts.
+    #     resume: Continue from the checkpoint files if they exist.
+    
+    # Return:
+    #     The mask of the finished sources. The wavefronts and the intensity
+    #     of back are initialized, from the checkpoint when resuming; a
+    #     checkpoint of other sources, plane or precision is a ValueError.
+    """
+    
+    if resume and os.path.exists(checkpoint + ".npz"):
+        wavefront = np.load(checkpoint + ".npy", mmap_mode = "r+")
+        with np.load(checkpoint + ".npz") as state:
+            intensity = state["intensity"]
+            done = state["done"]
+        if wavefront.shape != (source_count,) + shape or \
+                wavefront.dtype != dtype or len(done) != source_count or \
+                intensity.shape != shape:
+            raise ValueError(
+                "the checkpoint %s does not match the sources, the plane "
+                "or the precision of the run" % checkpoint
+                )
+        back.wavefront = wavefront
+        back.intensity = intensity
+        return done
+    
+    back.wavefront = np.lib.format.open_memmap(
+        checkpoint + ".npy", mode = "w+", dtype = dtype,
+        shape = (source_count,) + shape
+        )
+    back.intensity = np.zeros(shape)
+    return np.zeros(source_count, dtype = bool)
+
+def kirchhoff_integral(front, back, method="point", schedule="dynamic", batch=None,
+                       store=None, intensity_only=False, precision="double",
+                       checkpoint=None, resume=False, interval=600,
+                       distributed=False, coherence=None, tolerance=None,
+                       seed=0):
+    
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back.
+    #     method: The propagation method, see _propagate._wavefronts.
+    #     schedule: "dynamic" or "static", see _schedule.
+    #     batch: The number of sources in a batch, default about eight
+    #            batches per rank.
+    #     store: The .npy file of the wavefronts of back. The file is memory
+    #            mapped, so the memory of rank 0 is bounded by the batches
+    #            whatever the source count. Default in memory.
+    #     intensity_only: Only the intensity of back is computed. Each rank
+    #                     sums its |E|**2 and the sums are reduced on rank 0,
+    #                     the wavefronts are not stored.
+    #     precision: "double" or "single" (complex64 wavefronts and messages,
+    #                phases in float64), see accuracy for its error.
+    #     checkpoint: The path prefix of the checkpoint files. The wavefronts
+    #                 are memory mapped to checkpoint + ".npy" (store is
+    #                 ignored), and the finished sources and their intensity
+    #                 are saved by rank 0 every interval seconds. Only for
+    #                 the wavefronts gathered on rank 0.
+    #     resume: Skip the sources finished in the checkpoint files, after a
+    #             run was stopped.
+    #     interval: The time between two checkpoints (seconds).
+    #     distributed: Each rank keeps the wavefronts of its batches in the
+    #                  static schedule (an elements.RankWavefronts), nothing
+    #                  is sent to rank 0 and the intensity is summed on all
+    #                  the ranks. front must be distributed with the same
+    #                  batch, see source_spread and load.
+    #     coherence: An elements.Coherence of back, updated by each batch as
+    #                it is computed or received, so that the cuts of the
+    #                cross spectral density need no stored wavefronts (with
+    #                intensity_only). It is summed on rank 0, on all the
+    #                ranks when distributed.
+    #     tolerance: The relative standard error of the intensity. The
+    #                intensity is estimated from random batches of sources
+    #                until the error is below tolerance, see _adaptive; the
+    #                wavefronts are not stored.
+    #     seed: The seed of the order of the sources with a tolerance.
+    
+    # Return:
+    #     The wavefronts and the intensity of back, on rank 0. All the ranks,
+    #     rank 0 included, compute batches of sources; the batches are
+    #     written to the wavefront array and added to the intensity as they
+    #     arrive.
+    """
     
     rank = multi_process.Get_rank()
         
-    source_count = front.source.source_count
-    num = process_number
+    # The point sources, or the modes of a compressed front
+    source_count = len(front.wavefront)
+    shape = (2*back.size[1] + 1, 2*back.size[0] + 1)
+    dtype = _propagate._dtype(precision)
+    
+    batch = _batch(source_count, batch)
+    
+    if checkpoint is not None and (
+            intensity_only or distributed or tolerance is not None
+            ):
+        raise ValueError(
+            "a checkpoint needs the wavefronts gathered on rank 0, not "
+            "intensity_only, distributed or a tolerance"
+            )
+    
+    # Only the sources not finished in the checkpoint are propagated, a
+    # mismatched checkpoint is raised on all the ranks
+    pending = np.arange(source_count)
+    if checkpoint is not None:
+        if rank == 0:
+            try:
+                done = _load_checkpoint(
+                    back, checkpoint, source_count, shape, dtype, resume
+                    )
+                pending = np.flatnonzero(~done)
+            except ValueError as error:
+                pending = error
+        pending = multi_process.bcast(pending, root = 0)
+        if isinstance(pending, ValueError):
+            raise pending
+    batches = _batches(pending, batch)
+    
+    if tolerance is not None:
+        
+        _adaptive(
+            lambda indices: _propagate._wavefronts(
+                indices, front, back, method, precision
+                ),
+            back, source_count, shape, batch, tolerance, seed
+            )
     
-    p0 = source_count % (num - 1)
-    p1 = source_count // (num - 1)
-    parameters = list()
+    elif distributed:
+        
+        indices = _own(source_count, batch)
+        wavefronts = np.zeros((len(indices),) + shape, dtype = dtype)
+        
+        for start in range(0, len(indices), batch):
+            wavefronts[start:start + batch] = _propagate._wavefronts(
+                indices[start:start + batch], front, back, method, precision
+                )
+            if coherence is not None:
+                coherence.update(wavefronts[start:start + batch])
+        
+        back.wavefront = elements.RankWavefronts(
+            source_count, indices, wavefronts
+            )
+        back.intensity = np.zeros(shape)
+        multi_process.Allreduce(
+            [np.sum(np.abs(wavefronts)**2, 0), mpi.DOUBLE],
+            [back.intensity, mpi.DOUBLE], op = mpi.SUM
+            )
+        if coherence is not None:
+            _reduce_coherence(coherence)
     
-    if p0 == 0:
+    elif intensity_only:
         
-        for i in range(num - 1):
-            
-            parameters.append(range(p1*i, p1*(i + 1)))
-            
-    else:
+        intensity = np.zeros(shape)
         
-        for i in range(num - 1):
+        for number in _schedule(len(batches), schedule):
             
-            if i + 1 != num - 1:
-                parameters.append(range(p1*i, p1*(i + 1)))
-            else:
-                parameters.append(range(p1*(num - 2), p1*(num - 1) + p0))
+            results = _propagate._wavefronts(
+                batches[number], front, back, method, precision
+                )
+            intensity = intensity + np.sum(np.abs(results)**2, 0)
+            if coherence is not None:
+                coherence.update(results)
+        
+        if coherence is not None:
+            _reduce_coherence(coherence, 0)
+        
+        total = np.zeros(shape) if rank == 0 else None
+        multi_process.Reduce(
+            [intensity, mpi.DOUBLE], [total, mpi.DOUBLE] if rank == 0 else None,
+            op = mpi.SUM, root = 0
+            )
+        
+        if rank == 0:
+            back.wavefront = list()
+            back.intensity = total
     
-    if rank == 0:
+    elif rank == 0:
+        
+        if checkpoint is None:
+            if store is None:
+                back.wavefront = np.zeros(
+                    (source_count,) + shape, dtype = dtype
+                    )
+            else:
+                back.wavefront = np.lib.format.open_memmap(
+                    store, mode = "w+", dtype = dtype,
+                    shape = (source_count,) + shape
+                    )
+            back.intensity = np.zeros(shape)
+            done = np.zeros(source_count, dtype = bool)
+        
+        received = 0
+        saved = time.time()
+        
+        # The batches of the other ranks are received by a thread while
+        # rank 0 computes, and stored by rank 0 between its batches
+        messages = queue.Queue()
+        
+        def poll():
+            result = _receive(batches, shape, False, dtype)
+            if result is not None:
+                messages.put(result)
+            return result is not None
+        
+        end = _progress(poll)
         
-        for i in range(num - 1):
+        for number in _schedule(len(batches), schedule):
             
-            multi_process.Send([np.array(i), mpi.INT], 
-                               dest = i + 1, tag = i + 1)
+            results = _propagate._wavefronts(
+                batches[number], front, back, method, precision
+                )
+            _store(back, batches[number], results, done, coherence)
+            received = received + 1
             
-        for i in range(num - 1):
+            # The batches finished by the other ranks in the meantime, also
+            # received here if there is no thread
+            while poll():
+                pass
+            while not messages.empty():
+                result = messages.get()
+                _store(back, batches[result[0]], result[1], done, coherence)
+                received = received + 1
             
-            isize = len(parameters[i])
-            wavefronts = np.zeros(
-                (isize, int(2*back.size[1] + 1), int(2*back.size[0] + 1)),
-                dtype = np.complex128
-                )
-
-            multi_process.Recv(
-                [wavefronts, mpi.COMPLEX], source = i + 1, tag = 100*i + 1
-                )
+            if checkpoint is not None and time.time() - saved > interval:
+                _save_checkpoint(back, done, checkpoint)
+                saved = time.time()
+        
+        end()
+        while not messages.empty():
+            result = messages.get()
+            _store(back, batches[result[0]], result[1], done, coherence)
+            received = received + 1
+        
+        while received < len(batches):
+            result = _receive(batches, shape, True, dtype)
+            _store(back, batches[result[0]], result[1], done, coherence)
+            received = received + 1
+            
+            if checkpoint is not None and time.time() - saved > interval:
+                _save_checkpoint(back, done, checkpoint)
+                saved = time.time()
         
-            for k in range(isize):
-                back.wavefront.append(wavefronts[k, :, :])
-                
-        back.intensity = np.sum(np.abs(np.array(back.wavefront))**2, 0)
+        if checkpoint is not None:
+            _save_checkpoint(back, done, checkpoint)
+        elif store is not None:
+            back.wavefront.flush()
     
     else:
         
-        index = np.array(int())
-        multi_process.Recv([index, mpi.INT], source = 0, tag = rank)
+        requests = list()
         
-        results = [_propagate._point(i, front, back) 
-                   for i in parameters[index]]
+        for number in _schedule(len(batches), schedule):
+            
+            results = _propagate._wavefronts(
+                batches[number], front, back, method, precision
+                )
+            # One batch in flight while the next one is computed
+            mpi.Request.Waitall(requests)
+            requests = [multi_process.Isend(
+                [results, _datatype(dtype)], dest = 0, tag = number
+                )]
+        
+        mpi.Request.Waitall(requests)
+
+def fresnel_fft(front, back):
+    
+    # The Fresnel approximation of the integral by chirp-z FFTs
+    kirchhoff_integral(front, back, method = "fresnel")
+
+def accuracy(front, back, method, sample = 4, reference = "point",
+             precision = "double"):
+    
+    rank = multi_process.Get_rank()
+    
+    if rank == 0:
+        indices = np.unique(np.linspace(
+            0, len(front.wavefront) - 1, sample
+            ).astype(int))
+        result = _propagate._accuracy(
+            indices, front, back, method, reference, precision
+            )
+    else:
+        result = None
+    
+    # The relative error of method (in precision) against the reference
+    # (in double precision)
+    return multi_process.bcast(result, root = 0)
+
+def paraxial_bound(front, back):
+    
+    # The bound of the relative error of the "fresnel" and "separable"
+    # methods against the exact integral
+    return _propagate._paraxial_bound(front, back)
+
+def _shared(array, node):
+    
+    """
+    # Args:
+    #     array: The array to share, only needed on the root of the node.
+    #     node: The communicator of the ranks of a node.
+    
+    # Return:
+    #     The array in a shared memory window of the node, one copy per node.
+    """
+    
+    root = node.Get_rank() == 0
+    shape, dtype = node.bcast(
+        [array.shape, array.dtype.str] if root else None, root = 0
+        )
+    
+    shared = _window(shape, dtype, node)
+    if root:
+        shared[...] = array
+    node.Barrier()
+    
+    return shared
+
+def _window(shape, dtype, node):
+    
+    # An array of shape in a shared memory window of the node, allocated by
+    # the root of the node
+    dtype = np.dtype(dtype)
+    window = mpi.Win.Allocate_shared(
+        int(np.prod(shape))*dtype.itemsize if node.Get_rank() == 0 else 0,
+        dtype.itemsize, comm = node
+        )
+    buffer, itemsize = window.Shared_query(0)
+    shared = np.ndarray(buffer = buffer, dtype = dtype, shape = shape)
+    
+    _windows.append([window, shared])
+    return shared
+
+def _is_shared(array):
+    
+    # The array is in a shared memory window, see _window
+    return any(array is shared for window, shared in _windows)
 
-        multi_process.Send(
-            [np.array(results), mpi.COMPLEX], 
-            dest = 0, tag = 100*index + 1
+def share(front, back=None, precision="double"):
+    
+    """
+    # Args:
+    #     front：A class contains the properites of plane front.
+    #     back: A class contains the properties of plane back. If given, the
+    #           front to back transfer operator of the "matrix" method is
+    #           computed once per node and shared too.
+    #     precision: The precision of the shared operator.
+    
+    # Return:
+    #     The wavefronts and lens phases of front are moved to shared memory,
+    #     one read-only copy per node instead of one per rank. The wavefronts
+    #     of a WavefrontStore are read block by block into the window; a
+    #     distributed front (RankWavefronts) is a ValueError, each rank only
+    #     holds its own sources. To avoid a full copy per rank before, see
+    #     source_spread with shared.
+    """
+    
+    if isinstance(front.wavefront, elements.RankWavefronts):
+        raise ValueError(
+            "a distributed front holds only the sources of each rank, "
+            "it cannot be shared"
+            )
+    
+    node = multi_process.Split_type(mpi.COMM_TYPE_SHARED)
+    root = node.Get_rank() == 0
+    
+    if isinstance(front.wavefront, elements.WavefrontStore):
+        store = front.wavefront
+        wavefront = _window((len(store),) + store.shape, store.dtype, node)
+        if root:
+            for start in range(0, len(store), store.chunk):
+                wavefront[start:start + store.chunk] = \
+                    store[start:start + store.chunk]
+        node.Barrier()
+        front.wavefront = wavefront
+    elif not _is_shared(front.wavefront):
+        front.wavefront = _shared(
+            np.asarray(front.wavefront) if root else None, node
+            )
+    
+    # The lens phase of mode 1 is one plane for all the sources
+    if isinstance(front.lens, np.ndarray):
+        front.lens = _shared(front.lens if root else None, node)
+    
+    if back is not None:
+        dtype = _propagate._dtype(precision)
+        operator = _shared(
+            _propagate._transfer(front, back, slice(0, back.count), dtype)
+            if root else None,
+            node
+            )
+        _propagate._transfer_cache = [
+            _propagate._geometry(front, back, dtype), operator
+            ]
+
+def load(path, schedule="static", batch=None):
+    
+    """
+    # Args:
+    #     path: The directory of an element saved by OpticElements.save, the
+    #           front of the next kirchhoff_integral.
+    #     schedule: The schedule of the next kirchhoff_integral. "static",
+    #               each rank reads only the wavefronts of its own batches;
+    #               "dynamic", the batches of a rank are not known before,
+    #               the wavefronts are read from the blocks when indexed.
+    #     batch: The batch of the next kirchhoff_integral.
+    
+    # Return:
+    #     The element, see elements.load.
+    """
+    
+    element = elements.load(path)
+    
+    if schedule == "static" and len(element.wavefront):
+        element.wavefront.load(_own(len(element.wavefront), batch))
+    
+    return element
+
+def save(element, batch=None, path=None):
+    
+    """
+    # Args:
+    #     element: An element distributed with batch, see kirchhoff_integral.
+    #     batch: The batch of the element.
+    #     path: The directory of the element, default its name.
+    
+    # Return:
+    #     The element saved as by OpticElements.save, with blocks of batch
+    #     sources: each rank writes the blocks of its own batches, then rank
+    #     0 writes the header. load reads it back with the same batch.
+    """
+    
+    rank = multi_process.Get_rank()
+    path = element.name if path is None else path
+    count = len(element.wavefront)
+    batch = _batch(count, batch)
+    
+    if rank == 0:
+        elements._clear(path)
+    multi_process.Barrier()
+    
+    batches = _batches(np.arange(count), batch)
+    for number in _schedule(len(batches), "static"):
+        elements._save_block(path, number, element.wavefront[batches[number]])
+    multi_process.Barrier()
+    
+    if rank == 0:
+        elements._save_header(
+            path, element.header(), element.arrays(),
+            {"count": count, "chunk": batch,
+             "shape": list(element.zero.shape),
+             "dtype": np.dtype(element.wavefront.dtype).str}
             )
-            
\ No newline at end of file
+    multi_process.Barrier()
+
+def _sum(array):
+    
+    # The sum of an array over the ranks
+    total = np.zeros_like(array)
+    multi_process.Allreduce(np.ascontiguousarray(array), total, op = mpi.SUM)
+    return total
+
+def _rows(element):
+    
+    # The sources of element held by this rank: its own ones if it is
+    # distributed or loaded by rank, all of them on rank 0 if it is gathered
+    if isinstance(element.wavefront, elements.RankWavefronts):
+        return element.wavefront.indices
+    elif isinstance(element.wavefront, elements.WavefrontStore) and \
+            np.any(element.wavefront.rows >= 0):
+        return np.flatnonzero(element.wavefront.rows >= 0)
+    elif multi_process.Get_rank() == 0:
+        return np.arange(len(element.wavefront))
+    else:
+        return np.zeros(0, dtype = int)
+
+def coherent_modes(mode, oversampling=10, power=2, seed=0):
+    
+    """
+    # Args:
+    #     mode: An elements.TestCoherentMode of a distributed element (each
+    #           rank holds the wavefronts of its sources, see
+    #           kirchhoff_integral), or of an element gathered on rank 0.
+    #     oversampling, power: See elements._coherent_modes.
+    #     seed: The seed of the random vectors, each rank draws its own.
+    
+    # Return:
+    #     The modes and occupations of mode, on all the ranks. The
+    #     randomized SVD of the wavefronts held by the ranks, only arrays of
+    #     (pixels, n + oversampling) are summed over the ranks.
+    """
+    
+    rank = multi_process.Get_rank()
+    shape = mode.element.zero.shape
+    local = _rows(mode.element)
+    
+    # Every rank takes part in the sums, with no rows if it holds no source
+    block = np.zeros((len(local), mode.element.zero.size), dtype = complex)
+    for row, i in enumerate(local):
+        block[row, :] = np.ravel(mode.element.wavefront[i])
+    
+    mode.eig_value, eig_vector = elements._coherent_modes(
+        block, mode.n, "random", oversampling, power, _sum,
+        None if seed is None else seed + rank
+        )
+    mode.mode = [np.reshape(eig_vector[i, :], shape)
+                 for i in range(len(mode.eig_value))]
+
+def compress(element, threshold=0.999, modes=100, oversampling=10, power=2,
+             seed=0):
+    
+    """
+    # Args:
+    #     element: An element with its wavefronts, distributed or gathered
+    #              on rank 0, and its lens, mask and error.
+    #     threshold: The fraction of the energy kept by the modes.
+    #     modes: The most modes kept.
+    #     oversampling, power, seed: See coherent_modes.
+    
+    # Return:
+    #     [count, energy], the number of modes kept and their fraction of the
+    #     energy. The wavefronts of element are replaced on all the ranks by
+    #     its coherent modes weighted by sqrt(occupation), the fronts of the
+    #     next kirchhoff_integral, one per mode instead of one per source;
+    #     the lens, the mask and the error are folded into the modes. The
+    #     intensity of the planes after it is the sum over the modes.
+    """
+    
+    rank = multi_process.Get_rank()
+    shape = element.zero.shape
+    local = _rows(element)
+    
+    # The wavefronts under the effect of lens, mask and error
+    front = np.reshape(
+        _propagate._front_wave(local, element), (len(local), element.zero.size)
+        )
+    energy = _sum(np.array([np.sum(np.abs(front)**2)]))[0]
+    
+    value, vector = elements._coherent_modes(
+        front, modes, "random", oversampling, power, _sum,
+        None if seed is None else seed + rank
+        )
+    count = min(
+        len(value), np.searchsorted(np.cumsum(value) / energy, threshold) + 1
+        )
+    
+    element.wavefront = np.reshape(
+        np.sqrt(value[:count])[:, np.newaxis] * vector[:count],
+        (count,) + shape
+        )
+    element.lens = None
+    element.mask = None
+    element.error = np.copy(element.zero)
+    
+    return [count, np.sum(value[:count]) / energy]
@@ -22,34 +22,26 @@ Classes  : none.
 
 import elements 
 import propagate
-import pickle
-import numpy as np
 
 #-----------------------------------------------------------------------------#
-# classes
-
-source = elements.LightSource(
-    source_count = 2079,
-    wave_length = 1e-4,
-    source_sigma = [9.5, 3.1],
-    optic_planesize = [38, 13],
-    optic_pixelsize = [0.5, 0.5],
-    )
-source.gauss_source()
-
-sample_plane = elements.OpticElements(
-    source_class = source,
-    name = "sample_plane",
-    order = 3,
-    optic_location = 72.0e6,
-    optic_planesize = [64, 64],
-    optic_pixelsize = [0.1575, 0.1575],
-    optic_planecount = 16641
-    )
-
+# the sample plane, behind the slit saved by slit.py
 
 if __name__ == '__main__':
     
-    slit = pickle.load(open("slit.pkl", 'rb'))
-    propagate.kirchhoff_integral(slit, sample_plane)    
-    sample_plane.save() 
\ No newline at end of file
+    # Each rank reads only the slit wavefronts of its own batches and
+    # writes the sample plane wavefronts of the same batches
+    slit = propagate.load("slit", schedule = "static")
+    
+    # The source of the slit, with its seed
+    sample_plane = elements.OpticElements(
+        source_class = slit.source,
+        name = "sample_plane",
+        order = 3,
+        optic_location = 72.0e6,
+        optic_planesize = [64, 64],
+        optic_pixelsize = [0.1575, 0.1575],
+        optic_planecount = 16641
+        )
+    
+    propagate.kirchhoff_integral(slit, sample_plane, distributed = True)
+    propagate.save(sample_plane)
\ No newline at end of file
@@ -20,49 +20,42 @@ Classes  : none.
 #-----------------------------------------------------------------------------#
 # libraries
 
-import elements 
+import beamline
 import propagate
-import pickle
-import numpy as np
 
 #-----------------------------------------------------------------------------#
-# classes
-
-source = elements.LightSource(
-    source_count = 2079,
-    wave_length = 1e-4,
-    source_sigma = [9.5, 3.1],
-    optic_planesize = [38, 13],
-    optic_pixelsize = [0.5, 0.5],
-    )
-source.gauss_source()
-
-ideal_lens = elements.OpticElements(
-    source_class = source,
-    name = "lens",
-    order = 1,
-    optic_location = 40e6,
-    optic_planesize = [60, 60],
-    optic_pixelsize = [5.0, 5.0],
-    optic_planecount = 14641,
-    optic_focus = 29.3e6
-    )
-
-slit = elements.OpticElements(
-    source_class = source,
-    name = "slit",
-    order = 2,
-    optic_location = 69.3e6,
-    optic_planesize = [10, 13],
-    optic_pixelsize = [0.5, 0.5],
-    optic_planecount = 567,
-    )
+# the beamline, the source and the lens are shared with the other scripts
+# through the cache
+
+description = {
+    "source": {
+        "count": 2079,
+        "wave_length": 1e-4,
+        "sigma": [9.5, 3.1],
+        "size": [38, 13],
+        "pixel": [0.5, 0.5],
+        "seed": 0
+        },
+    "elements": [
+        {
+            "name": "lens",
+            "location": 40e6,
+            "size": [60, 60],
+            "pixel": [5.0, 5.0],
+            "focus": 29.3e6,
+            "cache": True
+            },
+        {
+            "name": "slit",
+            "location": 69.3e6,
+            "size": [10, 13],
+            "pixel": [0.5, 0.5]
+            }
+        ]
+    }
 
 if __name__ == '__main__':
     
-    propagate.source_spread(source, ideal_lens)
-    propagate.lens(source, ideal_lens, 1)
-    propagate.kirchhoff_integral(ideal_lens, slit)
+    source, planes = beamline.run(description)
     
-    slit.save() 
-
+    propagate.save(planes[-1])